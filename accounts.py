@@ -0,0 +1,236 @@
+import queue
+import signal
+import logging
+import multiprocessing
+
+from pika.adapters.select_connection import IOLoop
+
+from api import ChatWars
+from metrics import PrometheusWriter
+
+logger = logging.getLogger(__name__)
+
+
+class AccountManager(object):
+    """Runs several API accounts in one process on a single IOLoop.
+
+    Every account is a ChatWars instance with its own handlers, subscribers
+    and metrics. The Chat Wars API authenticates the AMQP connection with
+    the account credentials, so each account still has a connection of its
+    own, but all of them are driven by the one IOLoop thread of run().
+
+        manager = AccountManager()
+        cw = manager.add_account('login', 'password', setup=register_handlers)
+        manager.run()
+
+    With processes set, the accounts are spread round robin over that many
+    child processes, each running an AccountManager of its own. setup then
+    runs in the child, so it and the keyword arguments of add_account have
+    to be picklable, and metrics are the latest ones the children reported.
+
+    """
+
+    def __init__(self, processes=None, metrics_interval=10):
+        """Create a manager without accounts.
+
+        :param int processes: Spread the accounts over this many processes,
+            None runs them all in this process
+        :param float metrics_interval: Seconds between the metrics reports
+            of the child processes
+        """
+        if processes is not None and processes < 1:
+            raise ValueError('processes must be at least 1')
+        self.processes = processes
+        self.metrics_interval = metrics_interval
+        self._accounts = {}  # username to ChatWars, or to its spec with processes
+        self._ioloop = None
+        self._running = False
+        self._stopping = False
+        self._workers = []
+        self._reports = None
+        self._reported = {}  # username to (metrics, metrics_text) of a child
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def __contains__(self, username):
+        return username in self._accounts
+
+    def __getitem__(self, username):
+        return self._accounts[username]
+
+    @property
+    def usernames(self):
+        return list(self._accounts)
+
+    def add_account(self, username, password, setup=None, **kwargs):
+        """Add an account. Accounts added while running are connected right
+        away, unless they run in child processes.
+
+        :param str username: Chat Wars API username
+        :param str password: Chat Wars API password
+        :param function setup: Called with the ChatWars instance to register
+            handlers and subscribers
+        :param kwargs: Further arguments of ChatWars
+        :return: The instance, None when it runs in a child process
+        :rtype: api.ChatWars|None
+
+        """
+        if username in self._accounts:
+            raise ValueError(f'Account {username} was already added')
+        if self.processes:
+            if self._running:
+                raise ValueError('Accounts cannot be added to running processes')
+            self._accounts[username] = (username, password, setup, kwargs)
+            return None
+        account = ChatWars(username, password, ioloop=self._get_ioloop(), **kwargs)
+        account.add_on_stop_callback(self.on_account_stopped)
+        if setup is not None:
+            setup(account)
+        self._accounts[username] = account
+        if self._running:
+            self._ioloop.add_callback_threadsafe(account.start)
+        return account
+
+    def remove_account(self, username):
+        """Stop an account and forget it once its connection closed."""
+        account = self._accounts[username]
+        if self.processes:
+            raise ValueError('Accounts cannot be removed from child processes')
+        if self._running:
+            self._ioloop.add_callback_threadsafe(account.stop)
+        else:
+            del self._accounts[username]
+
+    def _get_ioloop(self):
+        if self._ioloop is None:
+            self._ioloop = IOLoop()
+        return self._ioloop
+
+    def on_account_stopped(self, account):
+        """Invoked when the connection of a stopped account closed. Once the
+        last account stopped during stop, the IOLoop is stopped too.
+
+        """
+        logger.info('Account %s stopped', account.username)
+        if not self._stopping:
+            self._accounts.pop(account.username, None)
+        elif all(not account.is_running for account in self._accounts.values()):
+            self._ioloop.stop()
+
+    def run(self):
+        """Connect every account and block until stop was called."""
+        self._stopping = False
+        if self.processes:
+            return self._run_processes()
+        ioloop = self._get_ioloop()
+        for account in self._accounts.values():
+            account.start()
+        self._running = True
+        try:
+            ioloop.start()
+        except KeyboardInterrupt:
+            # The IOLoop has to run again for the connections to close
+            self.stop()
+            ioloop.start()
+        finally:
+            self._running = False
+
+    def stop(self):
+        """Stop every account, run returns once all connections closed. Safe
+        to call from any thread and from signal handlers.
+
+        """
+        self._stopping = True
+        if self.processes:
+            for worker in self._workers:
+                if worker.is_alive():
+                    worker.terminate()  # SIGTERM, the child stops its accounts
+            return
+        if self._ioloop is not None:
+            self._ioloop.add_callback_threadsafe(self._stop_accounts)
+
+    def _stop_accounts(self):
+        running = [account for account in self._accounts.values() if account.is_running]
+        if not running:
+            self._ioloop.stop()
+        for account in running:
+            account.stop()
+
+    def _run_processes(self):
+        partitions = [[] for _ in range(min(self.processes, len(self._accounts)))]
+        for index, spec in enumerate(self._accounts.values()):
+            partitions[index % len(partitions)].append(spec)
+        context = multiprocessing.get_context()
+        self._reports = context.Queue()
+        self._workers = [context.Process(target=run_partition, name=f'accounts-{index}',
+                                         args=(specs, self._reports, self.metrics_interval))
+                         for index, specs in enumerate(partitions)]
+        for worker in self._workers:
+            worker.start()
+        self._running = True
+        try:
+            self._join_workers()
+        except KeyboardInterrupt:
+            self.stop()
+            self._join_workers()
+        finally:
+            self._running = False
+
+    def _join_workers(self):
+        # A child only exits once its reports are read, keep the queue empty
+        while any(worker.is_alive() for worker in self._workers):
+            self._collect_reports()
+            for worker in self._workers:
+                worker.join(0.5)
+        self._collect_reports()
+
+    def _collect_reports(self):
+        while self._reports is not None:
+            try:
+                username, metrics, text = self._reports.get_nowait()
+            except queue.Empty:
+                return
+            self._reported[username] = (metrics, text)
+
+    def metrics(self):
+        """Return the metrics of every account by username."""
+        if self.processes:
+            self._collect_reports()
+            return {username: report[0] for username, report in self._reported.items()}
+        return {username: account.metrics() for username, account in self._accounts.items()}
+
+    def metrics_text(self):
+        """Render the metrics of every account in the Prometheus text format."""
+        if self.processes:
+            self._collect_reports()
+            writer = PrometheusWriter()
+            for metrics, text in self._reported.values():
+                writer.merge(text)
+            return writer.render()
+        writer = PrometheusWriter()
+        for account in self._accounts.values():
+            account.metrics_text(writer)
+        return writer.render()
+
+
+def run_partition(specs, reports, interval):
+    """Entry point of a child process: run the accounts of specs and send
+    their metrics to the reports queue every interval seconds.
+
+    """
+    manager = AccountManager()
+    for username, password, setup, kwargs in specs:
+        manager.add_account(username, password, setup, **kwargs)
+
+    def report():
+        for username, account in manager._accounts.items():
+            reports.put((username, account.metrics(), account.metrics_text()))
+        if not manager._stopping:
+            manager._ioloop.add_timeout(interval, report)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: manager.stop())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent stops us
+    manager._get_ioloop().add_timeout(interval, report)
+    manager.run()
+    report()
@@ -0,0 +1,85 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AckBatcher(object):
+    """Collects delivery acknowledgements for a single channel and sends
+    them to RabbitMQ as one Basic.Ack with multiple=True.
+
+    Delivery tags are a per-channel counter, so a multiple ack for tag N
+    settles every outstanding delivery up to N. To keep that safe a delivery
+    is only counted once every delivery before it has been settled, either
+    acked (dispatch succeeded) or nacked (dispatch failed). Failed deliveries
+    are nacked immediately, so they are never covered by a later batch.
+
+    """
+
+    def __init__(self, channel, batch_size=1):
+        """Create a batcher for the given channel.
+
+        :param pika.channel.Channel channel: The channel deliveries came from
+        :param int batch_size: Number of acks to collect before sending them
+
+        """
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        self._channel = channel
+        self.batch_size = batch_size
+
+        self._frontier = 0  # every tag <= frontier has been settled
+        self._settled = {}  # out of order tags above the frontier
+        self._ack_tag = 0  # highest settled tag that still needs an ack
+        self.pending = 0
+
+        self.acked = 0
+        self.nacked = 0
+        self.flushes = 0
+
+    @property
+    def channel(self):
+        return self._channel
+
+    def settle(self, delivery_tag, success=True):
+        """Mark a delivery as handled. Returns True when a batch was sent.
+
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool success: False if the dispatch of the message failed
+
+        """
+        if not success:
+            self._channel.basic_nack(delivery_tag, requeue=False)
+            self.nacked += 1
+
+        if delivery_tag == self._frontier + 1 and not self._settled:
+            self._advance(delivery_tag, success)
+        else:
+            self._settled[delivery_tag] = success
+            settled = self._settled
+            while self._frontier + 1 in settled:
+                tag = self._frontier + 1
+                self._advance(tag, settled.pop(tag))
+
+        if self.pending >= self.batch_size:
+            self.flush()
+            return True
+        return False
+
+    def _advance(self, delivery_tag, success):
+        self._frontier = delivery_tag
+        if success:
+            self._ack_tag = delivery_tag
+            self.pending += 1
+
+    def flush(self):
+        """Send a Basic.Ack for everything collected so far."""
+        if not self.pending:
+            return
+        if self._channel.is_open:
+            self._channel.basic_ack(self._ack_tag, multiple=self.pending > 1)
+            self.acked += self.pending
+            self.flushes += 1
+        else:
+            # The broker will redeliver these once the channel is gone
+            logger.warning('Dropping %i acks, channel is closed', self.pending)
+        self.pending = 0
@@ -0,0 +1,92 @@
+class ApiActions(object):
+    """The outbound Chat Wars API requests. Each method builds the request
+    body and hands it to publish_message, which the client class using this
+    mixin provides, and returns whatever publish_message returns. For the
+    asyncio client that is an awaitable.
+
+    Wherever a token is taken, a (token, userId) pair is accepted as well
+    and binds the token, see bind_token. The client provides _tokens, a
+    pending.TokenBindings.
+
+    """
+
+    def bind_token(self, token, user_id):
+        """Remember which user a token belongs to. Replies of token based
+        actions carry only the userId, so without the binding they cannot be
+        matched to their request or cached under the token. Tokens granted
+        while running are bound on their own.
+
+        :param str token: User token
+        :param int user_id: userId of the token's user
+
+        """
+        self._tokens.bind(token, user_id)
+
+    def unpack_token(self, token):
+        """Return the token of a token or (token, userId) pair, binding
+        the pair.
+
+        """
+        if isinstance(token, tuple):
+            token, user_id = token
+            self.bind_token(token, user_id)
+        return token
+
+    def create_auth_code(self, user_id):
+        body = {'action': 'createAuthCode',
+                'payload': {
+                    'userId': user_id
+                     }
+                }
+
+        return self.publish_message(body)
+
+    def get_info(self):
+        body = {'action': 'getInfo'}
+
+        return self.publish_message(body)
+
+    def grant_token(self, user_id, auth_code):
+        body = {'action': 'grantToken',
+                'payload': {
+                    'userId': user_id,
+                    'authCode': auth_code
+                    }
+                }
+
+        return self.publish_message(body)
+
+    def auth_additional_operation(self, token, operation):
+        body = {'token': self.unpack_token(token),
+                'action': 'authAdditionalOperation',
+                'payload': {
+                    'operation': operation
+                    }
+                }
+
+        return self.publish_message(body)
+
+    def grant_additional_operation(self, token, auth_ao_id, auth_code):
+        body = {'token': self.unpack_token(token),
+                'action': 'grantAdditionalOperation',
+                'payload': {
+                    'requestId': auth_ao_id,
+                    'authCode': auth_code
+                    }
+                }
+
+        return self.publish_message(body)
+
+    def request_profile(self, token):
+        body = {'token': self.unpack_token(token),
+                'action': 'requestProfile'
+                }
+
+        return self.publish_message(body)
+
+    def request_stock(self, token):
+        body = {'token': self.unpack_token(token),
+                'action': 'requestStock'
+                }
+
+        return self.publish_message(body)
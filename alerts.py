@@ -0,0 +1,278 @@
+import logging
+import threading
+
+from time import monotonic
+from itertools import count
+from bisect import bisect_left, bisect_right, insort
+
+logger = logging.getLogger(__name__)
+
+STREAMS = ('offers', 'deals')
+KINDS = ('below', 'above')
+
+
+class Alert(object):
+    """A subscription to prices of an item on a stream. A below alert
+    matches prices at or under its threshold, an above alert prices at or
+    over it.
+
+    """
+
+    __slots__ = ('id', 'user', 'stream', 'item', 'kind', 'threshold', 'once', 'matches')
+
+    def __init__(self, alert_id, user, stream, item, kind, threshold, once):
+        self.id = alert_id
+        self.user = user
+        self.stream = stream
+        self.item = item
+        self.kind = kind
+        self.threshold = threshold
+        self.once = once
+        self.matches = 0
+
+    def __repr__(self):
+        return f'<Alert {self.id} {self.user} {self.stream} {self.item} {self.kind} {self.threshold}>'
+
+
+class AlertEngine(object):
+    """Matches the offers and deals streams against price alerts.
+
+    Alerts are indexed by stream, item and kind in lists of (threshold, id)
+    kept sorted, so a message is matched with one bisection plus the
+    matching alerts, whatever the number of alerts on other items or with
+    other thresholds. Matches are collected and passed to the handlers in
+    batches of (alert, update) pairs, once batch_size matches are waiting or
+    the oldest has waited max_delay seconds.
+
+        engine = AlertEngine()
+        engine.add_handler(notify_users)
+        engine.add_alert(user_id, 'Thread', 10)
+        engine.attach(cw)
+        cw.run()
+        engine.close()
+
+    match only checks max_delay when a message arrives. attach, or start,
+    runs a thread that flushes the matches of quiet streams, so handlers are
+    called from it as well as from the subscribers, one batch at a time.
+    Without it the caller has to call flush.
+
+    """
+
+    def __init__(self, batch_size=100, max_delay=1.0):
+        """Create an engine without alerts.
+
+        :param int batch_size: Matches passed to the handlers at once
+        :param float max_delay: Seconds a match may wait for its batch to
+            fill, 0 passes every message's matches right away
+        """
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._alerts = {}  # id to Alert
+        self._index = {}  # (stream, lowercased item, kind) to sorted [(threshold, id)]
+        self._users = {}  # user to set of ids
+        self._ids = count(1)
+        self._handlers = []
+        self._batch = []
+        self._batch_started = None
+        self._lock = threading.Lock()
+        self._delivering = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+        self.messages = 0
+        self.matched = 0
+        self.batches = 0
+
+    def __len__(self):
+        return len(self._alerts)
+
+    def add_handler(self, callback):
+        """Register a function that takes a list of (alert, update) pairs."""
+        if not callable(callback):
+            raise ValueError
+        self._handlers.append(callback)
+
+    def add_alert(self, user, item, threshold, kind='below', stream='offers', once=False):
+        """Subscribe a user to the prices of an item.
+
+        :param user: Whoever is notified, any hashable
+        :param str item: Item name, case insensitive
+        :param int threshold: Price to compare with
+        :param str kind: 'below' or 'above'
+        :param str stream: 'offers' or 'deals'
+        :param bool once: Remove the alert after its first match
+        :return: Id of the alert
+        :rtype: int
+
+        """
+        if kind not in KINDS:
+            raise ValueError(f'Unknown kind: {kind}')
+        if stream not in STREAMS:
+            raise ValueError(f'Unknown stream: {stream}')
+        with self._lock:
+            alert = Alert(next(self._ids), user, stream, item, kind, threshold, once)
+            self._alerts[alert.id] = alert
+            insort(self._index.setdefault((stream, item.lower(), kind), []), (threshold, alert.id))
+            self._users.setdefault(user, set()).add(alert.id)
+            return alert.id
+
+    def remove_alert(self, alert_id):
+        """Remove an alert. Returns False if there is no such alert."""
+        with self._lock:
+            return self._remove(alert_id)
+
+    def remove_user(self, user):
+        """Remove every alert of a user and return how many there were."""
+        with self._lock:
+            ids = list(self._users.get(user, ()))
+            for alert_id in ids:
+                self._remove(alert_id)
+            return len(ids)
+
+    def _remove(self, alert_id):
+        alert = self._alerts.pop(alert_id, None)
+        if alert is None:
+            return False
+        key = (alert.stream, alert.item.lower(), alert.kind)
+        entries = self._index[key]
+        del entries[bisect_left(entries, (alert.threshold, alert_id))]
+        if not entries:
+            del self._index[key]
+        ids = self._users[alert.user]
+        ids.discard(alert_id)
+        if not ids:
+            del self._users[alert.user]
+        return True
+
+    def get(self, alert_id):
+        return self._alerts.get(alert_id)
+
+    def alerts_of(self, user):
+        with self._lock:
+            return [self._alerts[alert_id] for alert_id in self._users.get(user, ())]
+
+    def attach(self, cw, streams=STREAMS):
+        """Subscribe the engine to streams of a ChatWars instance and
+        start flushing on time.
+
+        """
+        for stream in streams:
+            if stream not in STREAMS:
+                raise ValueError(f'Cannot match stream {stream}')
+            cw.subscribe(stream, self.on_offer if stream == 'offers' else self.on_deal)
+        self.start()
+
+    def start(self):
+        """Start the thread that passes matches to the handlers once they
+        waited max_delay, when no message arrives to do it.
+
+        """
+        if self.max_delay <= 0 or (self._flusher is not None and self._flusher.is_alive()):
+            return
+        self._closed.clear()
+        self._flusher = threading.Thread(target=self._flush_on_time, name='alerts-flush',
+                                         daemon=True)
+        self._flusher.start()
+
+    def close(self, timeout=None):
+        """Stop the flush thread and pass the waiting matches on."""
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout)
+            self._flusher = None
+        self.flush()
+
+    def _flush_on_time(self):
+        while True:
+            with self._lock:
+                delay = self.max_delay
+                batch = None
+                if self._batch:
+                    delay -= monotonic() - self._batch_started
+                    if delay <= 0:
+                        batch = self._take_batch()
+                        delay = self.max_delay
+            if batch:
+                self._deliver(batch)
+            if self._closed.wait(delay):
+                return
+
+    def on_offer(self, update):
+        """Match an update of the offers stream."""
+        return self.match('offers', update)
+
+    def on_deal(self, update):
+        """Match an update of the deals stream."""
+        return self.match('deals', update)
+
+    def match(self, stream, update, now=None):
+        """Find the alerts an update matches and add them to the batch.
+
+        :param str stream: 'offers' or 'deals'
+        :param dict update: Message body as dict
+        :param float now: Monotonic time, defaults to time.monotonic()
+        :return: The matched alerts
+        :rtype: list
+
+        """
+        item = update['item'].lower()
+        price = update['price']
+        now = monotonic() if now is None else now
+        batch = None
+        with self._lock:
+            self.messages += 1
+            matched = []
+            below = self._index.get((stream, item, 'below'))
+            if below:
+                # Thresholds at or above the price
+                start = bisect_left(below, (price,))
+                matched.extend(self._alerts[alert_id] for _, alert_id in below[start:])
+            above = self._index.get((stream, item, 'above'))
+            if above:
+                # Thresholds at or below the price
+                end = bisect_right(above, (price, float('inf')))
+                matched.extend(self._alerts[alert_id] for _, alert_id in above[:end])
+            if matched:
+                for alert in matched:
+                    alert.matches += 1
+                    if alert.once:
+                        self._remove(alert.id)
+                if not self._batch:
+                    self._batch_started = now
+                self._batch.extend((alert, update) for alert in matched)
+                self.matched += len(matched)
+            if self._batch and (len(self._batch) >= self.batch_size or
+                                now - self._batch_started >= self.max_delay):
+                batch = self._take_batch()
+        if batch:
+            self._deliver(batch)
+        return matched
+
+    def _take_batch(self):
+        batch, self._batch = self._batch, []
+        self._batch_started = None
+        self.batches += 1
+        return batch
+
+    def _deliver(self, batch):
+        with self._delivering:
+            for callback in self._handlers:
+                try:
+                    callback(batch)
+                except Exception:
+                    logger.exception('Alert handler %r failed', callback)
+
+    def flush(self):
+        """Pass the waiting matches to the handlers right away."""
+        with self._lock:
+            batch = self._take_batch() if self._batch else None
+        if batch:
+            self._deliver(batch)
+
+    def stats(self):
+        with self._lock:
+            return {'alerts': len(self._alerts), 'users': len(self._users),
+                    'indexes': len(self._index), 'messages': self.messages,
+                    'matched': self.matched, 'batches': self.batches,
+                    'waiting': len(self._batch)}
@@ -1,8 +1,11 @@
 import os
+import time
+import logging
 import objects
 from api import ChatWars
+RESTART_DELAY = 60  # seconds between runs after giving up or crashing
 stamp1 = objects.time_now()
-cw = ChatWars(os.environ['LOGIN'], os.environ['PASS'])
+cw = ChatWars(os.environ['LOGIN'], os.environ['PASS'], max_reconnect_attempts=20)
 objects.AuthCentre(os.environ['TOKEN']).start_message(stamp1)
 
 
@@ -10,9 +13,20 @@ def api_handler():
     global cw
     while True:
         try:
-            cw.run()  # this blocks execution
+            cw.run()  # this blocks execution, lost connections are reopened with backoff
         except KeyboardInterrupt:
             cw.stop()
+            return
+        except Exception:
+            logging.exception('The consumer crashed')
+            try:
+                cw.stop()  # close what is left before connecting again
+            except Exception:
+                logging.exception('Failed to stop the consumer')
+        else:
+            if not cw.gave_up:
+                return  # stopped
+        time.sleep(RESTART_DELAY)  # last resort, e.g. the broker was down for long
 
 
 if __name__ == '__main__':
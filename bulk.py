@@ -0,0 +1,160 @@
+import queue
+import threading
+
+from time import monotonic
+from functools import partial
+from concurrent.futures import CancelledError
+
+_FINISHED = object()
+
+
+class BulkJob(object):
+    """Runs one request per token with a bounded number of requests waiting
+    for their reply at the same time. Duplicate tokens are skipped, and
+    tokens that never get a reply end up in errors once their request times
+    out, so the job always finishes.
+
+    Replies are collected in replies, keyed by token, and can be consumed
+    while the job runs by iterating over results().
+
+    """
+
+    def __init__(self, submit, tokens, concurrency=100):
+        """Create a job, start it with start.
+
+        :param function submit: Takes a token, publishes its request and
+            returns the concurrent.futures.Future of the reply
+        :param iterable tokens: Tokens, may be a generator
+        :param int concurrency: Most requests waiting for a reply at once
+
+        """
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        self._submit = submit
+        self._tokens = iter(tokens)
+        self._seen = set()
+        self.concurrency = concurrency
+
+        self._lock = threading.Lock()
+        self._filling = False
+        self._wanted = False
+        self._exhausted = False
+        self._in_flight = 0
+        self._results = queue.Queue()
+        self._finished = threading.Event()
+
+        self.replies = {}
+        self.errors = {}
+        self.sent = 0
+        self.duplicates = 0
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        self.started = monotonic()
+        self._fill()
+        return self
+
+    @property
+    def done(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """Block until every token got its reply or timed out. Returns False
+        if the timeout passed first.
+
+        """
+        return self._finished.wait(timeout)
+
+    def results(self, timeout=None):
+        """Yield (token, reply) pairs as the replies arrive. For failed
+        requests the reply is the exception. Can only be consumed once.
+
+        :param float timeout: Most seconds to wait for the next result
+        :raises queue.Empty: if no result arrived within timeout
+
+        """
+        while True:
+            result = self._results.get(timeout=timeout)
+            if result is _FINISHED:
+                return
+            yield result
+
+    def progress(self):
+        """Return counters of the job and its throughput in replies per
+        second.
+
+        :rtype: dict
+
+        """
+        completed = len(self.replies) + len(self.errors)
+        elapsed = self.elapsed
+        if elapsed is None:
+            elapsed = monotonic() - self.started if self.started is not None else 0.0
+        return {'sent': self.sent, 'in_flight': self._in_flight,
+                'replied': len(self.replies), 'failed': len(self.errors),
+                'duplicates': self.duplicates, 'done': self.done,
+                'elapsed': elapsed, 'rate': completed / elapsed if elapsed else 0.0}
+
+    def _next_token(self):
+        for token in self._tokens:
+            if token in self._seen:
+                self.duplicates += 1
+                continue
+            self._seen.add(token)
+            return token
+        self._exhausted = True
+        return None
+
+    def _fill(self):
+        with self._lock:
+            if self._filling:
+                # Another thread is submitting, let it take the freed slot
+                self._wanted = True
+                return
+            self._filling = True
+        while True:
+            while True:
+                with self._lock:
+                    if self._in_flight >= self.concurrency or self._exhausted:
+                        break
+                    token = self._next_token()
+                    if token is None:
+                        break
+                    self._in_flight += 1
+                    self.sent += 1
+                try:
+                    future = self._submit(token)
+                except Exception as error:
+                    self._on_done(token, None, error)
+                    continue
+                future.add_done_callback(partial(self._on_done, token))
+            with self._lock:
+                if not self._wanted:
+                    self._filling = False
+                    break
+                self._wanted = False
+        self._check_finished()
+
+    def _on_done(self, token, future, error=None):
+        if future is not None:
+            if future.cancelled():
+                error = CancelledError()
+            else:
+                error = future.exception()
+        with self._lock:
+            self._in_flight -= 1
+            if error is None:
+                reply = self.replies[token] = future.result()
+            else:
+                reply = self.errors[token] = error
+        self._results.put((token, reply))
+        self._fill()
+
+    def _check_finished(self):
+        with self._lock:
+            if self._filling or not self._exhausted or self._in_flight or self.done:
+                return
+            self.elapsed = monotonic() - self.started
+            self._finished.set()
+        self._results.put(_FINISHED)
@@ -0,0 +1,159 @@
+import json
+import time
+import threading
+
+from time import monotonic
+from collections import OrderedDict
+
+DEFAULT_TTLS = {
+    'getInfo': 60,
+    'requestProfile': 60,
+    'requestStock': 60,
+}
+
+
+def reply_size(reply):
+    return len(json.dumps(reply, ensure_ascii=False))
+
+
+class CacheEntry(object):
+    __slots__ = ('reply', 'stored', 'size')
+
+    def __init__(self, reply, stored, size):
+        self.reply = reply
+        self.stored = stored
+        self.size = size
+
+
+class ResponseCache(object):
+    """LRU cache of API replies keyed by (action, token).
+
+    An entry is fresh for the TTL of its action. After that it is stale for
+    stale_ttl more seconds, stale entries are still returned so the caller
+    can use them while a new request refreshes the entry. Least recently
+    used entries are evicted once max_entries or max_bytes is exceeded.
+
+    """
+
+    def __init__(self, ttls=None, stale_ttl=300, max_entries=10000, max_bytes=None,
+                 sizeof=reply_size):
+        """Create an empty cache.
+
+        :param dict ttls: Action to seconds an entry is fresh. Only these
+            actions are cached, defaults to DEFAULT_TTLS
+        :param float stale_ttl: Seconds a stale entry is kept after its TTL
+        :param int max_entries: Most entries kept
+        :param int max_bytes: Most bytes of replies kept, measured by sizeof
+        :param function sizeof: Returns the size of a reply in bytes
+
+        """
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def caches(self, action):
+        return action in self.ttls
+
+    def get(self, action, key, now=None):
+        """Look an entry up. Returns (reply, fresh), reply is None on a miss
+        and fresh is False for stale entries.
+
+        :rtype: tuple
+
+        """
+        now = monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get((action, key))
+            if entry is None:
+                self.misses += 1
+                return None, False
+            age = now - entry.stored
+            ttl = self.ttls[action]
+            if age > ttl + self.stale_ttl:
+                self._remove((action, key))
+                self.expirations += 1
+                self.misses += 1
+                return None, False
+            self._entries.move_to_end((action, key))
+            if age > ttl:
+                self.stale_hits += 1
+                return entry.reply, False
+            self.hits += 1
+            return entry.reply, True
+
+    def put(self, action, key, reply, now=None):
+        """Store a reply, if its action is cached."""
+        if action not in self.ttls:
+            return
+        size = self._sizeof(reply) if self.max_bytes else 0
+        now = monotonic() if now is None else now
+        with self._lock:
+            if (action, key) in self._entries:
+                self._remove((action, key))
+            self._entries[(action, key)] = CacheEntry(reply, now, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes and self.bytes > self.max_bytes and len(self._entries) > 1):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, action, key):
+        with self._lock:
+            if (action, key) in self._entries:
+                self._remove((action, key))
+
+    def _remove(self, cache_key):
+        self.bytes -= self._entries.pop(cache_key).size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def get_state(self):
+        """Return every entry as an (action, key, reply, stored) tuple,
+        least recently used first. stored is the wall clock time the reply
+        was stored, so it survives a restart. Expired entries are included,
+        set_state skips them.
+
+        :rtype: list
+
+        """
+        offset = time.time() - monotonic()
+        with self._lock:
+            return [(action, key, entry.reply, entry.stored + offset)
+                    for (action, key), entry in self._entries.items()]
+
+    def set_state(self, state):
+        """Put the entries returned by get_state back, skipping those that
+        expired meanwhile and those of actions no longer cached.
+
+        """
+        offset = time.time() - monotonic()
+        now = monotonic()
+        for action, key, reply, stored in state:
+            stored -= offset
+            if action in self.ttls and now - stored <= self.ttls[action] + self.stale_ttl:
+                self.put(action, key, reply, stored)
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {'entries': len(self._entries), 'bytes': self.bytes,
+                'hits': self.hits, 'stale_hits': self.stale_hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0}
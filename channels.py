@@ -0,0 +1,112 @@
+import heapq
+
+from metrics import Histogram
+
+# Lower goes first, inbound replies are what requests wait for
+DEFAULT_CONSUMER_PRIORITIES = {'inbound': 0, 'deals': 1, 'offers': 1,
+                               'sex_digest': 2, 'au_digest': 2, 'yellow_pages': 2}
+
+
+def group_consumers(channels, consumers):
+    """Return a dict of channel name to the consumers on it.
+
+    :param str|dict|list channels: None for one channel, 'per_queue' for a
+        channel per consumer, a dict of channel name to consumer names or a
+        list of groups of consumer names
+    :param tuple consumers: Every consumer name
+    :rtype: dict
+
+    """
+    if channels is None:
+        return {'main': tuple(consumers)}
+    if channels == 'per_queue':
+        return {name: (name,) for name in consumers}
+    if not isinstance(channels, dict):
+        channels = {str(index): group for index, group in enumerate(channels)}
+    groups = {name: tuple(group) for name, group in channels.items()}
+    assigned = [name for group in groups.values() for name in group]
+    unknown = set(assigned) - set(consumers)
+    if unknown:
+        raise ValueError(f'Unknown consumers: {", ".join(sorted(unknown))}')
+    if len(assigned) != len(set(assigned)) or len(assigned) != len(consumers):
+        raise ValueError('Every consumer has to be on exactly one channel')
+    return groups
+
+
+class ConsumerChannel(object):
+    """An AMQP channel and the consumers on it. Delivery tags, acks and the
+    prefetch window belong to the channel, so each one has its own
+    AckBatcher and ack timer. A channel closed by the broker only takes its
+    own consumers down.
+
+    """
+
+    def __init__(self, name, consumers, prefetch_count=None):
+        self.name = name
+        self.consumers = consumers
+        self.prefetch_count = prefetch_count
+        self.channel = None
+        self.ack_batcher = None
+        self.ack_timeout = None
+        self.reopen_timeout = None
+        self.consumer_tags = {}
+        self.opened = 0  # deliveries on the current channel
+        self.buffered = 0
+        self.delivered = 0
+        self.wait_latency = Histogram()
+
+    def __repr__(self):
+        return f'<ConsumerChannel {self.name} {"+".join(self.consumers)}>'
+
+    @property
+    def is_open(self):
+        return self.channel is not None and self.channel.is_open
+
+    @property
+    def unacked(self):
+        """Deliveries the broker counts against the prefetch window."""
+        batcher = self.ack_batcher
+        if batcher is None:
+            return 0
+        return self.opened - batcher.acked - batcher.nacked
+
+    def reset(self, channel=None, ack_batcher=None):
+        self.channel = channel
+        self.ack_batcher = ack_batcher
+        self.ack_timeout = None
+        self.consumer_tags = {}
+        self.opened = 0
+
+    def stats(self):
+        return {'consumers': self.consumers, 'open': self.is_open,
+                'delivered': self.delivered, 'unacked': self.unacked,
+                'buffered': self.buffered, 'wait_latency': self.wait_latency.snapshot()}
+
+
+class DeliveryQueue(object):
+    """Deliveries waiting to be dispatched, lowest priority first and in
+    order of arrival within a priority.
+
+    """
+
+    def __init__(self, priorities):
+        self.priorities = dict(priorities)
+        self.lowest = max(self.priorities.values(), default=0) + 1
+        self.highest = min(self.priorities.values(), default=0)
+        self._heap = []
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, name, item):
+        self._sequence += 1
+        heapq.heappush(self._heap, (self.priorities.get(name, self.lowest), self._sequence, item))
+
+    def pop(self):
+        """Return the priority and item of the next delivery."""
+        priority, _, item = heapq.heappop(self._heap)
+        return priority, item
+
+    def clear(self):
+        self._heap = []
@@ -0,0 +1,176 @@
+import os
+import time
+import zlib
+import pickle
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+class Checkpoint(object):
+    """Snapshot of derived state, such as the latest digests and the reply
+    cache, in one compressed file, so a restarted consumer serves from warm
+    state instead of waiting for the next digests.
+
+    Components are registered by name and have to provide get_state and
+    set_state, as ResponseCache, AuctionDiffer, ExchangeSnapshot,
+    ShopDirectory and DealsAnalytics do. ChatWars loads the checkpoint in
+    run, saves it every interval seconds and once more after stop.
+
+    While running only the snapshot is taken on the IOLoop, it is pickled
+    and written on a thread, see save_in_background. get_state therefore
+    has to return data the component does not change afterwards.
+
+        checkpoint = Checkpoint('state.ckpt', interval=60)
+        checkpoint.register('shops', directory)
+        checkpoint.register('au_digest', differ)
+        cw = ChatWars(username, password, cache=cache, checkpoint=checkpoint)
+        cw.run()
+
+    """
+
+    def __init__(self, path, interval=None, level=1):
+        """Create a checkpoint without components.
+
+        :param str path: File of the snapshot
+        :param float interval: Seconds between saves while running, None
+            only saves after stop
+        :param int level: zlib compression level
+
+        """
+        self.path = path
+        self.interval = interval
+        self.level = level
+        self._components = {}
+        self.saved = None  # time.time() of the last save or of the loaded snapshot
+        self.saves = 0
+        self.snapshot_time = None
+        self.save_time = None
+        self.size = None
+        self._writer = None
+
+    def __contains__(self, name):
+        return name in self._components
+
+    def register(self, name, component):
+        """Add a component whose state is saved under name."""
+        if not callable(getattr(component, 'get_state', None)) or \
+                not callable(getattr(component, 'set_state', None)):
+            raise ValueError(f'{name} has no get_state and set_state')
+        self._components[name] = component
+
+    @property
+    def writing(self):
+        return self._writer is not None and self._writer.is_alive()
+
+    def snapshot(self):
+        """Collect the state of every component, on the thread that
+        changes them.
+
+        :return: (time.time(), states), to pass to write
+        :rtype: tuple
+
+        """
+        started = time.perf_counter()
+        states = {name: component.get_state() for name, component in self._components.items()}
+        self.snapshot_time = time.perf_counter() - started
+        return time.time(), states
+
+    def save(self):
+        """Write the state of every component. The file is replaced
+        atomically, a crash while saving leaves the previous snapshot.
+
+        """
+        self.write(self.snapshot())
+
+    def save_in_background(self):
+        """Take a snapshot on this thread and write it on another, so the
+        caller only pays for get_state. Skipped while the previous write is
+        still running.
+
+        :return: False if skipped
+        :rtype: bool
+
+        """
+        if self.writing:
+            logger.warning('Checkpoint %s is still being written, skipping this save', self.path)
+            return False
+        self._writer = threading.Thread(target=self._write_logged, args=(self.snapshot(),),
+                                        name='checkpoint-writer', daemon=True)
+        self._writer.start()
+        return True
+
+    def _write_logged(self, snapshot):
+        try:
+            self.write(snapshot)
+        except Exception:
+            logger.exception('Failed to save checkpoint %s', self.path)
+
+    def wait(self, timeout=None):
+        """Wait for a background write. Returns False if it is still
+        running after timeout seconds.
+
+        """
+        if self._writer is not None:
+            self._writer.join(timeout)
+        return not self.writing
+
+    def write(self, snapshot):
+        """Pickle, compress and write a snapshot taken by snapshot."""
+        started = time.perf_counter()
+        now, states = snapshot
+        data = zlib.compress(pickle.dumps((VERSION, now, states), pickle.HIGHEST_PROTOCOL),
+                             self.level)
+        with open(self.path + '.tmp', 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.path + '.tmp', self.path)
+        self.saved = now
+        self.saves += 1
+        self.save_time = time.perf_counter() - started
+        self.size = len(data)
+        logger.info('Saved checkpoint of %i bytes in %.3f seconds', self.size, self.save_time)
+
+    def load(self):
+        """Restore the registered components from the file. A missing or
+        unreadable file leaves them empty, so the consumer starts cold.
+
+        :return: Names of the restored components
+        :rtype: list
+
+        """
+        try:
+            with open(self.path, 'rb') as file:
+                version, saved, states = pickle.loads(zlib.decompress(file.read()))
+        except FileNotFoundError:
+            return []
+        except Exception:
+            logger.exception('Failed to read checkpoint %s, starting cold', self.path)
+            return []
+        if version != VERSION:
+            logger.warning('Checkpoint %s has version %s, starting cold', self.path, version)
+            return []
+        restored = []
+        for name, state in states.items():
+            component = self._components.get(name)
+            if component is None:
+                continue
+            try:
+                component.set_state(state)
+            except Exception:
+                logger.exception('Failed to restore %s from checkpoint', name)
+            else:
+                restored.append(name)
+        self.saved = saved
+        logger.info('Restored %s from a checkpoint of %.0f seconds ago',
+                    ', '.join(restored) or 'nothing', time.time() - saved)
+        return restored
+
+    def stats(self):
+        return {'components': list(self._components), 'saves': self.saves,
+                'saved': self.saved, 'snapshot_time': self.snapshot_time,
+                'save_time': self.save_time, 'bytes': self.size}
@@ -0,0 +1,51 @@
+import re
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+DECODERS = ('orjson', 'ujson', 'json')
+
+_ACTION = re.compile(rb'"action"\s*:\s*"([^"\\]*)"')
+
+
+def json_loads(body):
+    return json.loads(body)
+
+
+def get_decoder(name=None):
+    """Return a function that decodes a JSON message body. Without a name
+    the fastest installed backend is picked, the standard library json
+    module being the fallback.
+
+    :param str name: One of DECODERS
+    :rtype: function
+
+    """
+    for candidate in (name,) if name else DECODERS:
+        if candidate == 'json':
+            return json_loads
+        try:
+            module = __import__(candidate)
+        except ImportError:
+            if name:
+                raise
+            continue
+        logger.info('Decoding messages with %s', candidate)
+        return module.loads
+    raise ValueError(f'Unknown decoder: {name}')
+
+
+def peek_action(body):
+    """Return the action of an inbound message without decoding it, None
+    if it has none. Replies put the action before the payload, the first
+    "action" key of the body is taken as the top level one.
+
+    :param bytes body: The message body
+    :rtype: str|None
+
+    """
+    if isinstance(body, str):
+        body = body.encode()
+    match = _ACTION.search(body)
+    return match.group(1).decode() if match else None
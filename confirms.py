@@ -0,0 +1,99 @@
+from time import monotonic
+from metrics import Histogram
+from collections import OrderedDict
+
+
+class Delivery(object):
+    __slots__ = ('message', 'sent', 'attempts')
+
+    def __init__(self, message, sent, attempts):
+        self.message = message
+        self.sent = sent
+        self.attempts = attempts
+
+
+class DeliveryTracker(object):
+    """Keeps the messages published on a channel in confirm mode until the
+    broker acks or nacks them.
+
+    Publish sequence numbers grow by one per Basic.Publish, so the pending
+    deliveries are an OrderedDict in tag order. A single confirm is a dict
+    pop and a confirm with multiple=True pops from the front up to its tag,
+    which makes every confirm O(1) per settled message.
+
+    """
+
+    def __init__(self):
+        self._deliveries = OrderedDict()
+        self._tag = 0
+        self.started = monotonic()
+        self.published = 0
+        self.acked = 0
+        self.nacked = 0
+        self.latency = Histogram()
+
+    def __len__(self):
+        return len(self._deliveries)
+
+    def add(self, message, attempts=0):
+        """Record a message that has just been published and return its
+        delivery tag.
+
+        :param dict message: Message body that was published
+        :param int attempts: Number of times it was published before
+
+        """
+        self._tag += 1
+        self._deliveries[self._tag] = Delivery(message, monotonic(), attempts)
+        self.published += 1
+        return self._tag
+
+    def confirm(self, delivery_tag, multiple=False, ack=True):
+        """Settle deliveries confirmed by a Basic.Ack or Basic.Nack and
+        return them.
+
+        :param int delivery_tag: The delivery tag of the confirm frame
+        :param bool multiple: Whether every delivery up to the tag is settled
+        :param bool ack: False for a Basic.Nack
+        :rtype: list
+
+        """
+        deliveries = self._deliveries
+        if multiple:
+            settled = []
+            while deliveries:
+                tag = next(iter(deliveries))
+                if tag > delivery_tag:
+                    break
+                settled.append(deliveries.popitem(last=False)[1])
+        else:
+            delivery = deliveries.pop(delivery_tag, None)
+            settled = [delivery] if delivery is not None else []
+
+        now = monotonic()
+        for delivery in settled:
+            self.latency.observe(now - delivery.sent)
+        if ack:
+            self.acked += len(settled)
+        else:
+            self.nacked += len(settled)
+        return settled
+
+    def reset(self):
+        """Start over for a new channel, returning the deliveries that were
+        never confirmed on the old one.
+
+        :rtype: list
+
+        """
+        unconfirmed = list(self._deliveries.values())
+        self._deliveries.clear()
+        self._tag = 0
+        return unconfirmed
+
+    def stats(self):
+        elapsed = monotonic() - self.started
+        return {'published': self.published, 'acked': self.acked,
+                'nacked': self.nacked, 'unconfirmed': len(self._deliveries),
+                'publish_rate': self.published / elapsed if elapsed else 0.0,
+                'confirm_latency': self.latency.snapshot()}
@@ -0,0 +1,252 @@
+import os
+import time
+import pickle
+import threading
+
+from array import array
+from collections import deque
+
+DEFAULT_WINDOWS = (60, 3600, 86400)
+
+
+class Window(object):
+    """Running aggregates of the deals of one item within span seconds.
+
+    tail is the sequence number of the oldest deal inside the window. The
+    minimum and maximum are monotonic deques of sequence numbers, so they
+    are updated in amortized O(1) per deal instead of rescanning.
+
+    """
+
+    __slots__ = ('span', 'tail', 'count', 'volume', 'turnover', 'lows', 'highs')
+
+    def __init__(self, span, tail=0):
+        self.span = span
+        self.tail = tail
+        self.count = 0
+        self.volume = 0
+        self.turnover = 0
+        self.lows = deque()
+        self.highs = deque()
+
+
+class DealSeries(object):
+    """Deals of one item in a ring buffer of typed arrays, 16 bytes per deal,
+    plus one Window per span. Deals are addressed by an ever growing
+    sequence number, position in the arrays is the sequence number modulo
+    the capacity. The buffer doubles when deals inside the longest window
+    would be overwritten.
+
+    """
+
+    __slots__ = ('times', 'prices', 'quantities', 'start', 'end', 'windows')
+
+    def __init__(self, spans, capacity=16):
+        self.times = array('d', bytes(8 * capacity))
+        self.prices = array('i', bytes(4 * capacity))
+        self.quantities = array('i', bytes(4 * capacity))
+        self.start = 0
+        self.end = 0
+        self.windows = [Window(span) for span in spans]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def add(self, now, price, quantity):
+        self.expire(now)
+        capacity = len(self.times)
+        if self.end - self.start == capacity:
+            self._grow()
+            capacity = len(self.times)
+        position = self.end % capacity
+        self.times[position] = now
+        self.prices[position] = price
+        self.quantities[position] = quantity
+        sequence = self.end
+        self.end += 1
+
+        prices = self.prices
+        for window in self.windows:
+            window.count += 1
+            window.volume += quantity
+            window.turnover += price * quantity
+            lows = window.lows
+            while lows and prices[lows[-1] % capacity] >= price:
+                lows.pop()
+            lows.append(sequence)
+            highs = window.highs
+            while highs and prices[highs[-1] % capacity] <= price:
+                highs.pop()
+            highs.append(sequence)
+
+    def expire(self, now):
+        capacity = len(self.times)
+        times, prices, quantities = self.times, self.prices, self.quantities
+        for window in self.windows:
+            cutoff = now - window.span
+            tail = window.tail
+            while tail < self.end and times[tail % capacity] < cutoff:
+                position = tail % capacity
+                window.count -= 1
+                window.volume -= quantities[position]
+                window.turnover -= prices[position] * quantities[position]
+                tail += 1
+            window.tail = tail
+            while window.lows and window.lows[0] < tail:
+                window.lows.popleft()
+            while window.highs and window.highs[0] < tail:
+                window.highs.popleft()
+        self.start = min(window.tail for window in self.windows)
+
+    def _grow(self):
+        capacity = len(self.times)
+        for name in ('times', 'prices', 'quantities'):
+            old = getattr(self, name)
+            new = array(old.typecode, bytes(old.itemsize * capacity * 2))
+            for sequence in range(self.start, self.end):
+                new[sequence % (capacity * 2)] = old[sequence % capacity]
+            setattr(self, name, new)
+
+    def stats(self, window):
+        capacity = len(self.times)
+        volume = window.volume
+        return {'deals': window.count, 'volume': volume,
+                'vwap': window.turnover / volume if volume else None,
+                'min': self.prices[window.lows[0] % capacity] if window.lows else None,
+                'max': self.prices[window.highs[0] % capacity] if window.highs else None}
+
+
+class DealsAnalytics(object):
+    """Rolling VWAP, volume and price range per item over sliding windows,
+    built from the deals stream. Every deal updates the aggregates of its
+    item incrementally, nothing is recomputed on reads.
+
+        analytics = DealsAnalytics()
+        cw.subscribe('deals', analytics.add_deal)
+        analytics.stats('Thread', 3600)
+
+    Times are wall clock seconds, so that a state saved with dump is still
+    valid after a restart.
+
+    """
+
+    def __init__(self, windows=DEFAULT_WINDOWS):
+        """Create empty analytics.
+
+        :param tuple windows: Window spans in seconds
+
+        """
+        self.windows = tuple(sorted(windows))
+        self._series = {}
+        self._lock = threading.Lock()
+        self.received = 0
+
+    def __len__(self):
+        return len(self._series)
+
+    def add_deal(self, update, now=None):
+        """Add an update of the deals stream.
+
+        :param dict update: Message body as dict
+        :param float now: Time of the deal, defaults to time.time()
+
+        """
+        now = time.time() if now is None else now
+        item = update['item']
+        with self._lock:
+            series = self._series.get(item)
+            if series is None:
+                series = self._series[item] = DealSeries(self.windows)
+            series.add(now, update['price'], update['qty'])
+            self.received += 1
+
+    def stats(self, item, window=3600, now=None):
+        """Return deals, volume, vwap, min and max price of an item in a
+        window.
+
+        :param str item: Item name
+        :param int window: Span of one of the windows in seconds
+        :rtype: dict|None
+
+        """
+        index = self.windows.index(window)
+        with self._lock:
+            series = self._series.get(item)
+            if series is None:
+                return None
+            series.expire(time.time() if now is None else now)
+            return series.stats(series.windows[index])
+
+    def items(self):
+        with self._lock:
+            return list(self._series)
+
+    def memory(self):
+        """Return the bytes used by the deal arrays."""
+        with self._lock:
+            return sum(series.times.itemsize * len(series.times) +
+                       series.prices.itemsize * len(series.prices) +
+                       series.quantities.itemsize * len(series.quantities)
+                       for series in self._series.values())
+
+    def get_state(self):
+        """Return the whole state as plain data. Arrays are kept as raw
+        bytes and window aggregates as they are, so set_state does not
+        replay deals.
+
+        """
+        with self._lock:
+            state = {}
+            for item, series in self._series.items():
+                state[item] = (series.times.tobytes(), series.prices.tobytes(),
+                               series.quantities.tobytes(), series.start, series.end,
+                               [(w.tail, w.count, w.volume, w.turnover, list(w.lows), list(w.highs))
+                                for w in series.windows])
+            return self.windows, self.received, state
+
+    def set_state(self, state):
+        """Replace the state with one returned by get_state."""
+        windows, received, state = state
+        if tuple(windows) != self.windows:
+            raise ValueError(f'State has windows {windows}, expected {self.windows}')
+        series_of = {}
+        for item, (times, prices, quantities, start, end, aggregates) in state.items():
+            series = DealSeries(self.windows, 0)
+            series.times.frombytes(times)
+            series.prices.frombytes(prices)
+            series.quantities.frombytes(quantities)
+            series.start, series.end = start, end
+            for window, (tail, count, volume, turnover, lows, highs) in zip(series.windows, aggregates):
+                window.tail, window.count = tail, count
+                window.volume, window.turnover = volume, turnover
+                window.lows.extend(lows)
+                window.highs.extend(highs)
+            series_of[item] = series
+        with self._lock:
+            self._series = series_of
+            self.received = received
+
+    def dump(self, path):
+        """Write the whole state to a file, see get_state.
+
+        :param str path: File to write
+
+        """
+        data = pickle.dumps(self.get_state(), pickle.HIGHEST_PROTOCOL)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """Create analytics from a file written by dump.
+
+        :param str path: File to read
+        :rtype: DealsAnalytics
+
+        """
+        with open(path, 'rb') as file:
+            state = pickle.load(file)
+        analytics = cls(state[0])
+        analytics.set_state(state)
+        return analytics
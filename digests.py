@@ -0,0 +1,260 @@
+import sys
+import time
+import threading
+
+from array import array
+
+AUCTION_FIELDS = ('price', 'buyerName', 'buyerCastle', 'status')
+
+
+class AuctionDiff(object):
+    """Lots that appeared, changed or disappeared between two au_digest
+    snapshots. changed holds (previous, current) pairs.
+
+    """
+
+    __slots__ = ('new', 'changed', 'closed')
+
+    def __init__(self):
+        self.new = []
+        self.changed = []
+        self.closed = []
+
+    def __bool__(self):
+        return bool(self.new or self.changed or self.closed)
+
+    def __repr__(self):
+        return f'<AuctionDiff new={len(self.new)} changed={len(self.changed)} closed={len(self.closed)}>'
+
+
+class AuctionDiffer(object):
+    """Turns the full au_digest snapshots into differences. The previous
+    snapshot is kept indexed by lotId together with the tuple of the
+    compared fields of every lot, so a digest is diffed in time linear in
+    its own size and that of the previous one.
+
+        differ = AuctionDiffer()
+        differ.add_handler(on_lots)
+        cw.subscribe('au_digest', differ.apply)
+
+    """
+
+    def __init__(self, fields=AUCTION_FIELDS):
+        """Create a differ with an empty previous snapshot, the first digest
+        reports all its lots as new.
+
+        :param tuple fields: Lot fields whose change makes a lot changed
+
+        """
+        self.fields = tuple(fields)
+        self._lots = {}  # lotId to (signature, lot)
+        self._handlers = []
+        self._lock = threading.Lock()
+        self.digests = 0
+
+    def __len__(self):
+        return len(self._lots)
+
+    def add_handler(self, callback):
+        """Register a function that takes an AuctionDiff, it is only called
+        for digests that changed something.
+
+        """
+        if not callable(callback):
+            raise ValueError
+        self._handlers.append(callback)
+
+    def get(self, lot_id):
+        entry = self._lots.get(lot_id)
+        return entry[1] if entry is not None else None
+
+    def apply(self, update):
+        """Diff an au_digest snapshot against the previous one, pass the
+        difference to the handlers and return it.
+
+        :param list update: Message body, the list of lots
+        :rtype: AuctionDiff
+
+        """
+        diff = AuctionDiff()
+        fields = self.fields
+        with self._lock:
+            previous = self._lots
+            current = {}
+            for lot in update:
+                lot_id = lot['lotId']
+                signature = tuple([lot.get(field) for field in fields])
+                entry = previous.pop(lot_id, None)
+                if entry is None:
+                    diff.new.append(lot)
+                elif entry[0] != signature:
+                    diff.changed.append((entry[1], lot))
+                current[lot_id] = (signature, lot)
+            # Whatever is left of the previous snapshot is gone now
+            diff.closed = [entry[1] for entry in previous.values()]
+            self._lots = current
+            self.digests += 1
+        if diff:
+            for callback in self._handlers:
+                callback(diff)
+        return diff
+
+    def memory(self):
+        """Estimate the bytes held by the kept snapshot."""
+        with self._lock:
+            size = sys.getsizeof(self._lots)
+            for signature, lot in self._lots.values():
+                size += sys.getsizeof(signature) + sys.getsizeof(lot)
+                size += sum(sys.getsizeof(value) for value in lot.values())
+            return size
+
+    def stats(self):
+        return {'lots': len(self._lots), 'digests': self.digests, 'bytes': self.memory()}
+
+    def get_state(self):
+        """Return the previous snapshot as plain data for a checkpoint."""
+        with self._lock:
+            return self.digests, [entry[1] for entry in self._lots.values()]
+
+    def set_state(self, state):
+        """Make a snapshot returned by get_state the previous one, so the
+        first digest after a restart only reports what changed meanwhile.
+
+        """
+        digests, lots = state
+        fields = self.fields
+        current = {lot['lotId']: (tuple([lot.get(field) for field in fields]), lot) for lot in lots}
+        with self._lock:
+            self._lots = current
+            self.digests = digests
+
+
+class ExchangeSnapshot(object):
+    """Latest exchange prices per item from the sex_digest stream.
+
+    Every digest builds a new snapshot dict that replaces the previous one
+    with a single assignment, and per item histories are replaced rather
+    than modified, so readers on other threads never need a lock and always
+    see a consistent digest.
+
+    Handlers get a list of (item, previous, current) best prices of the
+    items whose price moved by at least min_change and min_ratio since the
+    last change reported for them. Items that appear or disappear are
+    reported with None on the missing side.
+
+        snapshot = ExchangeSnapshot(min_ratio=0.05)
+        snapshot.add_handler(on_price_moves)
+        cw.subscribe('sex_digest', snapshot.apply)
+
+    """
+
+    def __init__(self, min_change=1, min_ratio=0.0, history=32):
+        """Create an empty snapshot.
+
+        :param int min_change: Smallest price difference that is reported
+        :param float min_ratio: Smallest price difference relative to the
+            previous price that is reported
+        :param int history: Number of reported prices kept per item
+
+        """
+        self.min_change = min_change
+        self.min_ratio = min_ratio
+        self.history_size = history
+        self._snapshot = {}  # name to tuple of prices
+        self._reference = {}  # name to the last reported best price
+        self._history = {}  # name to array of time, price pairs
+        self._handlers = []
+        self.digests = 0
+        self.updated = None
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def __contains__(self, item):
+        return item in self._snapshot
+
+    def add_handler(self, callback):
+        """Register a function that takes a list of (item, previous, current)."""
+        if not callable(callback):
+            raise ValueError
+        self._handlers.append(callback)
+
+    def price(self, item):
+        """Return the best price of an item, None if it is not on the exchange."""
+        prices = self._snapshot.get(item)
+        return prices[0] if prices else None
+
+    def prices(self, item):
+        """Return every price of an item in the digest, cheapest first."""
+        return self._snapshot.get(item, ())
+
+    def items(self):
+        return list(self._snapshot)
+
+    def history(self, item):
+        """Return the reported prices of an item as (time, price) pairs."""
+        points = self._history.get(item)
+        if points is None:
+            return []
+        return [(points[i], int(points[i + 1])) for i in range(0, len(points), 2)]
+
+    def _moved(self, previous, current):
+        if previous is None or current is None:
+            return previous is not current
+        difference = abs(current - previous)
+        return difference >= self.min_change and difference >= self.min_ratio * previous
+
+    def apply(self, update, now=None):
+        """Replace the snapshot with a sex_digest and report the price moves.
+
+        :param list update: Message body, list of {'name', 'prices'}
+        :param float now: Time of the digest, defaults to time.time()
+        :rtype: list
+
+        """
+        now = time.time() if now is None else now
+        snapshot = {entry['name']: tuple(entry['prices']) for entry in update}
+        reference = self._reference
+        changes = []
+        for name, prices in snapshot.items():
+            current = prices[0] if prices else None
+            previous = reference.get(name)
+            if self._moved(previous, current):
+                changes.append((name, previous, current))
+        for name in reference.keys() - snapshot.keys():
+            if reference[name] is not None:
+                changes.append((name, reference[name], None))
+
+        for name, previous, current in changes:
+            reference[name] = current
+            if current is not None:
+                points = self._history.get(name, ())
+                kept = array('d', points[max(len(points) - 2 * (self.history_size - 1), 0):])
+                kept.extend((now, current))
+                self._history[name] = kept
+        self._snapshot = snapshot
+        self.digests += 1
+        self.updated = now
+        if changes:
+            for callback in self._handlers:
+                callback(changes)
+        return changes
+
+    def get_state(self):
+        """Return the snapshot, reported prices and histories as plain data."""
+        return (self._snapshot, dict(self._reference),
+                {name: points.tobytes() for name, points in self._history.items()},
+                self.digests, self.updated)
+
+    def set_state(self, state):
+        """Replace the state with one returned by get_state."""
+        snapshot, reference, history, digests, updated = state
+        histories = {}
+        for name, points in history.items():
+            histories[name] = array('d')
+            histories[name].frombytes(points)
+        self._history = histories
+        self._reference = dict(reference)
+        self._snapshot = dict(snapshot)
+        self.digests = digests
+        self.updated = updated
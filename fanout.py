@@ -0,0 +1,397 @@
+import os
+import time
+import pickle
+import signal
+import logging
+import threading
+import multiprocessing
+
+from itertools import count
+from functools import partial
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+
+logger = logging.getLogger(__name__)
+
+
+def item_key(stream, event):
+    """Partition key of offers and deals, the item name."""
+    return event['item']
+
+
+class FanOut(object):
+    """Spreads stream events over worker processes for CPU-bound analytics.
+
+    The consumer keeps decoding, routing and acknowledging on its IOLoop,
+    submit only appends the event to the batch of its partition. Events
+    with the same key, by default the item name, always go to the same
+    process and arrive there in order, so each worker holds the complete
+    state of its items. Batches are pickled and sent over a pipe per
+    worker once batch_size events are waiting or the oldest waited
+    max_delay seconds, a thread flushes them when the streams are quiet. A
+    full pipe blocks submit, which holds the acks until the workers catch
+    up. A worker that died is started again with fresh state when its next
+    batch is sent, its pending queries fail.
+
+    factory is called with the partition number in every worker and
+    returns an object whose handle(stream, event) is called for each
+    event. Whatever handle returns besides None is sent back and passed to
+    the result handlers in lists, on the thread that gathers them. query
+    runs a function on the state of the partition of a key, its error is
+    passed back as a RuntimeError with its repr if it cannot be pickled.
+
+        class Analytics(object):
+            def __init__(self, partition):
+                self.book = OrderBook()
+            def handle(self, stream, event):
+                self.book.add_offer(event)
+
+        def best_price(analytics, item):
+            return analytics.book.best_price(item)
+
+        fanout = FanOut(Analytics, processes=4)
+        fanout.start()
+        fanout.attach(cw, ('offers',))
+        fanout.query('Thread', best_price, 'Thread').result()
+
+    Under the spawn start method factory, the events and the query
+    functions have to be picklable, i.e. defined at module level.
+
+    """
+
+    def __init__(self, factory, processes=None, key=item_key, batch_size=512, max_delay=0.05,
+                 start_method=None):
+        """Create a fan-out, start launches the workers.
+
+        :param function factory: Takes the partition number and returns the
+            state of a worker, see above
+        :param int processes: Worker processes, defaults to the CPU count
+        :param function key: Takes stream and event and returns the
+            hashable partition key
+        :param int batch_size: Events sent to a worker at once at most
+        :param float max_delay: Seconds an event may wait for its batch
+        :param str start_method: multiprocessing start method, defaults to
+            the platform's
+
+        """
+        processes = processes or os.cpu_count() or 1
+        if processes < 1 or batch_size < 1:
+            raise ValueError('processes and batch_size must be at least 1')
+        self.factory = factory
+        self.processes = processes
+        self.key = key
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._context = multiprocessing.get_context(start_method)
+        self._batches = [[] for _ in range(processes)]
+        self._waiting = 0
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._workers = []
+        self._inboxes = []
+        self._outboxes = []
+        self._gatherer = None
+        self._flusher = None
+        self._handlers = []
+        self._futures = {}  # query id to (partition, Future)
+        self._ids = count(1)
+        self.submitted = 0
+        self.batches = 0
+        self.results = 0
+        self.restarts = 0
+
+    def __len__(self):
+        return self._waiting
+
+    @property
+    def is_running(self):
+        return self._gatherer is not None and self._gatherer.is_alive()
+
+    def add_handler(self, callback):
+        """Register a function that takes a list of results of a worker."""
+        if not callable(callback):
+            raise ValueError
+        self._handlers.append(callback)
+
+    def start(self):
+        """Start the worker processes and the thread that gathers results."""
+        if self.is_running:
+            raise ValueError('The fan-out is already running')
+        self._closed.clear()
+        self._workers = [None] * self.processes
+        self._inboxes = [None] * self.processes
+        self._outboxes = [None] * self.processes
+        for partition in range(self.processes):
+            self._spawn(partition)
+        self._gatherer = threading.Thread(target=self._gather, name='fanout-gather', daemon=True)
+        self._gatherer.start()
+        self._flusher = threading.Thread(target=self._flush_on_time, name='fanout-flush',
+                                         daemon=True)
+        self._flusher.start()
+
+    def _spawn(self, partition):
+        inbox, inbox_writer = self._context.Pipe(duplex=False)
+        outbox_reader, outbox = self._context.Pipe(duplex=False)
+        worker = self._context.Process(target=run_worker, name=f'fanout-{partition}',
+                                       args=(partition, self.factory, inbox, outbox),
+                                       daemon=True)
+        worker.start()
+        inbox.close()
+        outbox.close()
+        self._workers[partition] = worker
+        self._inboxes[partition] = inbox_writer
+        self._outboxes[partition] = outbox_reader
+
+    def _restart(self, partition):
+        """Replace a dead worker. Called with the lock held."""
+        worker = self._workers[partition]
+        if worker.is_alive():
+            worker.terminate()
+        worker.join()
+        logger.warning('Fan-out worker %s exited with code %s, restarting it without its state',
+                       worker.name, worker.exitcode)
+        self._inboxes[partition].close()
+        for query_id, (query_partition, future) in list(self._futures.items()):
+            if query_partition == partition and self._futures.pop(query_id, None) is not None:
+                future.set_exception(RuntimeError(f'Fan-out worker {worker.name} died'))
+        self._spawn(partition)
+        self.restarts += 1
+
+    def attach(self, cw, streams=('offers', 'deals')):
+        """Subscribe the fan-out to streams of a ChatWars instance."""
+        for stream in streams:
+            cw.subscribe(stream, partial(self.submit, stream))
+
+    def partition(self, key):
+        return hash(key) % self.processes
+
+    def submit(self, stream, event, now=None):
+        """Queue an event for the worker of its partition.
+
+        :param str stream: Stream name, passed on to handle
+        :param event: Decoded message body or anything picklable
+        :param float now: Monotonic time, defaults to time.monotonic()
+
+        """
+        partition = hash(self.key(stream, event)) % self.processes
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            batch = self._batches[partition]
+            batch.append((stream, event))
+            if not self._waiting:
+                self._oldest = now
+            self._waiting += 1
+            self.submitted += 1
+            if len(batch) >= self.batch_size:
+                self._send(partition)
+            if self._waiting and now - self._oldest >= self.max_delay:
+                self._send_all()
+
+    def flush(self):
+        """Send every waiting event right away."""
+        with self._lock:
+            self._send_all()
+
+    def _flush_on_time(self):
+        while True:
+            with self._lock:
+                delay = self.max_delay
+                if self._waiting:
+                    delay -= time.monotonic() - self._oldest
+                    if delay <= 0:
+                        self._send_all()
+                        delay = self.max_delay
+            if self._closed.wait(delay):
+                return
+
+    def _send_all(self):
+        for partition, batch in enumerate(self._batches):
+            if batch:
+                self._send(partition)
+        self._oldest = None
+
+    def _send(self, partition):
+        batch = self._batches[partition]
+        self._batches[partition] = []
+        self._waiting -= len(batch)
+        self.batches += 1
+        self._deliver(partition, pickle.dumps(('events', batch), pickle.HIGHEST_PROTOCOL))
+
+    def _deliver(self, partition, data):
+        if not self._workers[partition].is_alive():
+            self._restart(partition)
+        try:
+            self._inboxes[partition].send_bytes(data)
+        except OSError:  # the worker died after the check
+            self._restart(partition)
+            self._inboxes[partition].send_bytes(data)
+
+    def query(self, key, function, *args):
+        """Run function(state, *args) in the worker of key's partition,
+        after the events submitted before, and return a Future of its
+        result.
+
+        :rtype: concurrent.futures.Future
+
+        """
+        return self._query(hash(key) % self.processes, function, args)
+
+    def broadcast(self, function, *args):
+        """Run function(state, *args) in every worker, e.g. to collect their
+        statistics. Returns a list of Futures in partition order.
+
+        """
+        return [self._query(partition, function, args) for partition in range(self.processes)]
+
+    def _query(self, partition, function, args):
+        future = Future()
+        with self._lock:
+            if self._batches[partition]:
+                self._send(partition)
+            query_id = next(self._ids)
+            data = pickle.dumps(('query', (query_id, function, args)), pickle.HIGHEST_PROTOCOL)
+            if not self._workers[partition].is_alive():
+                self._restart(partition)
+            self._futures[query_id] = (partition, future)
+            self._deliver(partition, data)
+        return future
+
+    def _gather(self):
+        while True:
+            # Restarted workers replace their outbox, pick them up every round
+            outboxes = [outbox for outbox in self._outboxes if not outbox.closed]
+            if not outboxes:
+                if self._closed.wait(0.5):
+                    return
+                continue
+            for outbox in wait(outboxes, 0.5):
+                try:
+                    kind, payload = pickle.loads(outbox.recv_bytes())
+                except (EOFError, OSError):
+                    outbox.close()
+                    continue
+                except Exception:
+                    logger.exception('Fan-out failed to load a message of a worker')
+                    continue
+                if kind == 'results':
+                    self.results += len(payload)
+                    for callback in self._handlers:
+                        try:
+                            callback(payload)
+                        except Exception:
+                            logger.exception('Fan-out result handler %r failed', callback)
+                else:
+                    self._resolve(*payload)
+
+    def _resolve(self, query_id, success, data):
+        _, future = self._futures.pop(query_id, (None, None))
+        if future is None:  # failed when its worker died
+            return
+        try:
+            value = pickle.loads(data)
+        except Exception as error:
+            success, value = False, RuntimeError(f'Cannot load the reply of a query: {error!r}')
+        if success:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def close(self, timeout=None):
+        """Send the waiting events, stop the workers once they handled
+        everything and wait for their last results.
+
+        """
+        with self._lock:
+            self._send_all()
+            for inbox in self._inboxes:
+                try:
+                    inbox.send_bytes(pickle.dumps(('stop', None)))
+                except OSError:
+                    pass  # the worker died, a restart would lose nothing
+                inbox.close()
+        self._closed.set()
+        for worker in self._workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                logger.warning('Fan-out worker %s did not stop, terminating it', worker.name)
+                worker.terminate()
+        if self._gatherer is not None:
+            self._gatherer.join(timeout)
+        if self._flusher is not None:
+            self._flusher.join(timeout)
+        for _, future in self._futures.values():
+            future.set_exception(RuntimeError('The fan-out was closed'))
+        self._futures.clear()
+        self._workers, self._inboxes, self._outboxes = [], [], []
+
+    def stats(self):
+        return {'processes': self.processes, 'submitted': self.submitted,
+                'batches': self.batches, 'waiting': self._waiting, 'results': self.results,
+                'restarts': self.restarts,
+                'alive': sum(worker.is_alive() for worker in self._workers)}
+
+
+def run_worker(partition, factory, inbox, outbox):
+    """Entry point of a worker process: handle the batches of inbox and
+    send results and query replies to outbox until told to stop.
+
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the consumer stops us
+    state = factory(partition)
+    while True:
+        try:
+            kind, payload = pickle.loads(inbox.recv_bytes())
+        except EOFError:
+            break
+        if kind == 'events':
+            results = []
+            for stream, event in payload:
+                try:
+                    result = state.handle(stream, event)
+                except Exception:
+                    logger.exception('Fan-out worker %i failed to handle %s', partition, stream)
+                    continue
+                if result is not None:
+                    results.append(result)
+            if results:
+                try:
+                    data = pickle.dumps(('results', results), pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    logger.exception('Fan-out worker %i cannot send its results', partition)
+                    continue
+                outbox.send_bytes(data)
+        elif kind == 'query':
+            query_id, function, args = payload
+            try:
+                success, value = True, function(state, *args)
+            except Exception as error:
+                success, value = False, error
+            success, data = envelope(success, value)
+            outbox.send_bytes(pickle.dumps(('reply', (query_id, success, data)),
+                                           pickle.HIGHEST_PROTOCOL))
+        else:
+            break
+    outbox.close()
+
+
+def envelope(success, value):
+    """Pickle the result or error of a query on its own, so that one that
+    cannot be pickled, or unpickled, fails the query and not the worker or
+    the gathering thread.
+
+    :return: success and the pickled value
+    :rtype: tuple
+
+    """
+    try:
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if not success:
+            pickle.loads(data)  # exceptions with extra arguments fail here
+        return success, data
+    except Exception as error:
+        if success:
+            value = RuntimeError(f'Cannot send the result of a query: {error!r}')
+        else:
+            value = RuntimeError(repr(value))
+        return False, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,138 @@
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """Fixed bucket histogram of durations in seconds. Observing a value is
+    a binary search over the bucket bounds, memory does not grow with the
+    number of observations.
+
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in.
+
+        :param float q: Quantile between 0 and 1
+        :rtype: float
+
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class QueueMetrics(object):
+    """Counters and latencies of one consumer."""
+
+    __slots__ = ('received', 'acked', 'rejected', 'skipped', 'decode_errors',
+                 'handler_errors', 'bytes', 'handler_latency', 'delivery_latency')
+
+    def __init__(self):
+        self.received = 0
+        self.acked = 0
+        self.rejected = 0
+        self.skipped = 0
+        self.decode_errors = 0
+        self.handler_errors = 0
+        self.bytes = 0
+        self.handler_latency = Histogram()
+        self.delivery_latency = Histogram()
+
+    def snapshot(self):
+        return {'received': self.received, 'acked': self.acked,
+                'rejected': self.rejected, 'skipped': self.skipped,
+                'decode_errors': self.decode_errors,
+                'handler_errors': self.handler_errors, 'bytes': self.bytes,
+                'handler_latency': self.handler_latency.snapshot(),
+                'delivery_latency': self.delivery_latency.snapshot()}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+class PrometheusWriter(object):
+    """Collects samples and renders them in the Prometheus text exposition
+    format. Samples of the same metric are grouped under one TYPE line.
+
+    """
+
+    def __init__(self, prefix='cw_'):
+        self.prefix = prefix
+        self._metrics = {}  # name to (type, lines)
+
+    def _lines(self, name, kind):
+        entry = self._metrics.get(name)
+        if entry is None:
+            entry = self._metrics[name] = (kind, [])
+        return entry[1]
+
+    def counter(self, name, value, **labels):
+        name = self.prefix + name
+        self._lines(name, 'counter').append(f'{name}{format_labels(labels)} {value}')
+
+    def gauge(self, name, value, **labels):
+        name = self.prefix + name
+        self._lines(name, 'gauge').append(f'{name}{format_labels(labels)} {value}')
+
+    def histogram(self, name, histogram, **labels):
+        name = self.prefix + name
+        lines = self._lines(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}')
+        lines.append(f'{name}_bucket{format_labels(dict(labels, le="+Inf"))} {histogram.count}')
+        lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+        lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+    def merge(self, text):
+        """Add the samples of a text rendered by another writer."""
+        lines = None
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                name, kind = line[7:].split(' ', 1)
+                lines = self._lines(name, kind)
+            elif line and lines is not None:
+                lines.append(line)
+
+    def render(self):
+        output = []
+        for name, (kind, lines) in self._metrics.items():
+            output.append(f'# TYPE {name} {kind}')
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
@@ -0,0 +1,272 @@
+"""Compact records for stream data that is kept around.
+
+Decoded messages are dicts, which cost several hundred bytes each in
+overhead. The classes here store the same fields in __slots__, with item,
+castle and other repeated names interned so every record shares one copy.
+Records are optional, build them where data is retained:
+
+    deals = []
+    cw.subscribe('deals', lambda update: deals.append(Deal.from_dict(update)))
+
+or let wrap convert the updates of a stream before they reach a function.
+Records support update['key'], update.get('key'), keys, values and items
+with the API field names, so the consumers of this repo accept them in
+place of dicts.
+
+"""
+from sys import intern
+
+
+def intern_name(value):
+    return intern(value) if isinstance(value, str) else value
+
+
+class Record(object):
+    """Base of the records. KEYS maps the API field names to attributes."""
+
+    __slots__ = ()
+    KEYS = {}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.KEYS[key])
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self.KEYS and getattr(self, self.KEYS[key]) is not None
+
+    def get(self, key, default=None):
+        attribute = self.KEYS.get(key)
+        if attribute is None:
+            return default
+        value = getattr(self, attribute)
+        return default if value is None else value
+
+    def keys(self):
+        """Return the API field names that are set, like dict.keys."""
+        return [key for key, attribute in self.KEYS.items() if getattr(self, attribute) is not None]
+
+    def values(self):
+        return [value for value in (getattr(self, attribute) for attribute in self.KEYS.values())
+                if value is not None]
+
+    def items(self):
+        return [(key, getattr(self, attribute)) for key, attribute in self.KEYS.items()
+                if getattr(self, attribute) is not None]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        """Return the record as the dict it was built from, without the
+        fields that were missing.
+
+        """
+        return {key: self._export(value) for key, value in self.items()}
+
+    @staticmethod
+    def _export(value):
+        if isinstance(value, tuple):
+            return [item.to_dict() if isinstance(item, Record) else item for item in value]
+        if isinstance(value, Record):
+            return value.to_dict()
+        return value
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, attribute) == getattr(other, attribute) for attribute in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f'{attribute}={getattr(self, attribute)!r}' for attribute in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+class Offer(Record):
+    __slots__ = ('seller_id', 'seller_name', 'seller_castle', 'item', 'qty', 'price')
+    KEYS = {'sellerId': 'seller_id', 'sellerName': 'seller_name',
+            'sellerCastle': 'seller_castle', 'item': 'item', 'qty': 'qty', 'price': 'price'}
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        record.seller_id = data.get('sellerId')
+        record.seller_name = data.get('sellerName')
+        record.seller_castle = intern_name(data.get('sellerCastle'))
+        record.item = intern_name(data.get('item'))
+        record.qty = data.get('qty')
+        record.price = data.get('price')
+        return record
+
+
+class Deal(Record):
+    __slots__ = ('seller_id', 'seller_name', 'seller_castle', 'buyer_id', 'buyer_name',
+                 'buyer_castle', 'item', 'qty', 'price')
+    KEYS = {'sellerId': 'seller_id', 'sellerName': 'seller_name',
+            'sellerCastle': 'seller_castle', 'buyerId': 'buyer_id', 'buyerName': 'buyer_name',
+            'buyerCastle': 'buyer_castle', 'item': 'item', 'qty': 'qty', 'price': 'price'}
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        record.seller_id = data.get('sellerId')
+        record.seller_name = data.get('sellerName')
+        record.seller_castle = intern_name(data.get('sellerCastle'))
+        record.buyer_id = data.get('buyerId')
+        record.buyer_name = data.get('buyerName')
+        record.buyer_castle = intern_name(data.get('buyerCastle'))
+        record.item = intern_name(data.get('item'))
+        record.qty = data.get('qty')
+        record.price = data.get('price')
+        return record
+
+
+class AuctionLot(Record):
+    __slots__ = ('lot_id', 'item_name', 'seller_tag', 'seller_name', 'seller_castle',
+                 'quality', 'ended_at', 'started_at', 'buyer_tag', 'buyer_name',
+                 'buyer_castle', 'status', 'price')
+    KEYS = {'lotId': 'lot_id', 'itemName': 'item_name', 'sellerTag': 'seller_tag',
+            'sellerName': 'seller_name', 'sellerCastle': 'seller_castle',
+            'quality': 'quality', 'endAt': 'ended_at', 'startedAt': 'started_at',
+            'buyerTag': 'buyer_tag', 'buyerName': 'buyer_name', 'buyerCastle': 'buyer_castle',
+            'status': 'status', 'price': 'price'}
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        record.lot_id = data.get('lotId')
+        record.item_name = intern_name(data.get('itemName'))
+        record.seller_tag = intern_name(data.get('sellerTag'))
+        record.seller_name = data.get('sellerName')
+        record.seller_castle = intern_name(data.get('sellerCastle'))
+        record.quality = intern_name(data.get('quality'))
+        record.ended_at = data.get('endAt')
+        record.started_at = data.get('startedAt')
+        record.buyer_tag = intern_name(data.get('buyerTag'))
+        record.buyer_name = data.get('buyerName')
+        record.buyer_castle = intern_name(data.get('buyerCastle'))
+        record.status = intern_name(data.get('status'))
+        record.price = data.get('price')
+        return record
+
+
+class ShopOffer(Record):
+    __slots__ = ('item', 'price', 'mana')
+    KEYS = {'item': 'item', 'price': 'price', 'mana': 'mana'}
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        record.item = intern_name(data.get('item'))
+        record.price = data.get('price')
+        record.mana = data.get('mana')
+        return record
+
+
+class Shop(Record):
+    __slots__ = ('link', 'name', 'owner_name', 'owner_castle', 'kind', 'mana', 'offers')
+    KEYS = {'link': 'link', 'name': 'name', 'ownerName': 'owner_name',
+            'ownerCastle': 'owner_castle', 'kind': 'kind', 'mana': 'mana', 'offers': 'offers'}
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        record.link = data.get('link')
+        record.name = data.get('name')
+        record.owner_name = data.get('ownerName')
+        record.owner_castle = intern_name(data.get('ownerCastle'))
+        record.kind = intern_name(data.get('kind'))
+        record.mana = data.get('mana')
+        record.offers = tuple(ShopOffer.from_dict(offer) for offer in data.get('offers', ()))
+        return record
+
+
+class Profile(Record):
+    """Payload of a requestProfile reply, the profile fields flattened."""
+
+    __slots__ = ('user_id', 'user_name', 'castle', 'class_', 'lvl', 'exp', 'atk', 'def_',
+                 'hp', 'mana', 'gold', 'pouches', 'guild', 'guild_tag', 'stamina')
+    KEYS = {'userId': 'user_id', 'userName': 'user_name', 'castle': 'castle',
+            'class': 'class_', 'lvl': 'lvl', 'exp': 'exp', 'atk': 'atk', 'def': 'def_',
+            'hp': 'hp', 'mana': 'mana', 'gold': 'gold', 'pouches': 'pouches',
+            'guild': 'guild', 'guild_tag': 'guild_tag', 'stamina': 'stamina'}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a profile from the payload of the reply."""
+        profile = data.get('profile', {})
+        record = cls.__new__(cls)
+        record.user_id = data.get('userId')
+        for key, attribute in cls.KEYS.items():
+            if key != 'userId':
+                setattr(record, attribute, profile.get(key))
+        record.castle = intern_name(record.castle)
+        record.class_ = intern_name(record.class_)
+        record.guild_tag = intern_name(record.guild_tag)
+        return record
+
+    def to_dict(self):
+        profile = super().to_dict()
+        return {'userId': profile.pop('userId', None), 'profile': profile}
+
+
+class Stock(Record):
+    """Payload of a requestStock reply, the stock as interned item names to
+    quantities.
+
+    """
+
+    __slots__ = ('user_id', 'stock', 'stock_size', 'stock_limit')
+    KEYS = {'userId': 'user_id', 'stock': 'stock', 'stockSize': 'stock_size',
+            'stockLimit': 'stock_limit'}
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        record.user_id = data.get('userId')
+        record.stock = {intern(item): quantity for item, quantity in data.get('stock', {}).items()}
+        record.stock_size = data.get('stockSize')
+        record.stock_limit = data.get('stockLimit')
+        return record
+
+
+# Stream to the record of each of its updates, digests are lists of them
+STREAM_MODELS = {'offers': Offer, 'deals': Deal, 'au_digest': AuctionLot, 'yellow_pages': Shop}
+REPLY_MODELS = {'requestProfile': Profile, 'requestStock': Stock}
+
+
+def from_update(stream, update):
+    """Convert an update of a stream into records. Digests become lists.
+
+    :param str stream: 'offers', 'deals', 'au_digest' or 'yellow_pages'
+    :param dict|list update: Message body
+    :rtype: Record|list
+
+    """
+    model = STREAM_MODELS[stream]
+    if isinstance(update, list):
+        return [model.from_dict(entry) for entry in update]
+    return model.from_dict(update)
+
+
+def from_reply(reply):
+    """Convert the payload of a requestProfile or requestStock reply."""
+    return REPLY_MODELS[reply['action']].from_dict(reply.get('payload', {}))
+
+
+def wrap(stream, callback):
+    """Return a subscriber that passes records instead of dicts to callback.
+
+        cw.subscribe('deals', wrap('deals', history.append))
+
+    """
+    if stream not in STREAM_MODELS:
+        raise ValueError(f'No records for stream {stream}')
+
+    def subscriber(update):
+        return callback(from_update(stream, update))
+
+    return subscriber
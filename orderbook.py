@@ -0,0 +1,165 @@
+import threading
+
+from time import monotonic
+from collections import deque, OrderedDict
+from bisect import bisect_left, bisect_right, insort
+
+
+class ItemBook(object):
+    """Offers of a single item that have not expired yet, grouped into
+    price levels. prices is kept sorted, cheapest first, so the best price
+    is the first element and the level of a price is found by bisection.
+    Offers are also kept in order of arrival, which is the order they
+    expire in.
+
+    """
+
+    __slots__ = ('prices', 'levels', 'offers')
+
+    def __init__(self):
+        self.prices = []
+        self.levels = {}  # price to [quantity, offers]
+        self.offers = deque()  # (arrived, price, quantity)
+
+    def __len__(self):
+        return len(self.offers)
+
+    def add(self, price, quantity, now):
+        level = self.levels.get(price)
+        if level is None:
+            level = self.levels[price] = [0, 0]
+            insort(self.prices, price)
+        level[0] += quantity
+        level[1] += 1
+        self.offers.append((now, price, quantity))
+
+    def expire(self, cutoff):
+        offers = self.offers
+        while offers and offers[0][0] < cutoff:
+            _, price, quantity = offers.popleft()
+            level = self.levels[price]
+            level[0] -= quantity
+            level[1] -= 1
+            if not level[1]:
+                del self.levels[price]
+                del self.prices[bisect_left(self.prices, price)]
+
+    def best(self):
+        """Return (price, quantity) of the cheapest level, None if empty."""
+        if not self.prices:
+            return None
+        price = self.prices[0]
+        return price, self.levels[price][0]
+
+    def depth(self, levels=5):
+        """Return (price, quantity) of the cheapest levels."""
+        return [(price, self.levels[price][0]) for price in self.prices[:levels]]
+
+    def quantity_below(self, price):
+        """Return the quantity offered at price or less."""
+        end = bisect_right(self.prices, price)
+        return sum(self.levels[level][0] for level in self.prices[:end])
+
+
+class OrderBook(object):
+    """Market state per item built from the offers stream.
+
+    Offers only ever arrive, the stream has no cancellations, so each offer
+    counts for ttl seconds. Expired offers are dropped lazily whenever an
+    item is updated or read. At most max_items items are kept, the one
+    updated least recently is evicted first.
+
+    Subscribe it to the offers stream with:
+
+        cw.subscribe('offers', book.add_offer)
+
+    """
+
+    def __init__(self, ttl=300, max_items=5000):
+        """Create an empty book.
+
+        :param float ttl: Seconds an offer is counted for
+        :param int max_items: Most items kept
+
+        """
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.received = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def add_offer(self, update, now=None):
+        """Add an update of the offers stream.
+
+        :param dict update: Message body as dict
+        :param float now: Arrival time, defaults to time.monotonic()
+
+        """
+        now = monotonic() if now is None else now
+        item = update['item']
+        with self._lock:
+            book = self._items.get(item)
+            if book is None:
+                book = self._items[item] = ItemBook()
+                if len(self._items) > self.max_items:
+                    self._items.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self._items.move_to_end(item)
+                book.expire(now - self.ttl)
+            book.add(update['price'], update['qty'], now)
+            self.received += 1
+
+    def _book(self, item, now):
+        book = self._items.get(item)
+        if book is not None:
+            book.expire((monotonic() if now is None else now) - self.ttl)
+        return book
+
+    def best_price(self, item, now=None):
+        """Return (price, quantity) of the cheapest offers of an item, None
+        if there are none.
+
+        """
+        with self._lock:
+            book = self._book(item, now)
+            return book.best() if book is not None else None
+
+    def depth(self, item, levels=5, now=None):
+        """Return (price, quantity) of the cheapest price levels of an item."""
+        with self._lock:
+            book = self._book(item, now)
+            return book.depth(levels) if book is not None else []
+
+    def quantity_below(self, item, price, now=None):
+        """Return the quantity of an item offered at price or less."""
+        with self._lock:
+            book = self._book(item, now)
+            return book.quantity_below(price) if book is not None else 0
+
+    def offers_per_minute(self, item, now=None):
+        """Return the average rate of offers of an item over the last ttl
+        seconds.
+
+        """
+        with self._lock:
+            book = self._book(item, now)
+            return len(book) * 60 / self.ttl if book is not None else 0.0
+
+    def items(self):
+        with self._lock:
+            return list(self._items)
+
+    def stats(self):
+        with self._lock:
+            return {'items': len(self._items), 'received': self.received,
+                    'evicted': self.evicted,
+                    'offers': sum(len(book) for book in self._items.values()),
+                    'levels': sum(len(book.prices) for book in self._items.values())}
@@ -0,0 +1,200 @@
+import logging
+import threading
+
+from time import monotonic
+from pending import request_key
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Lower goes first. Auth flows wait for a user, profile and stock requests
+# are mostly bulk sweeps.
+DEFAULT_PRIORITIES = {
+    'createAuthCode': 0,
+    'grantToken': 0,
+    'authAdditionalOperation': 0,
+    'grantAdditionalOperation': 0,
+    'getInfo': 1,
+    'requestProfile': 2,
+    'requestStock': 2,
+}
+
+# Actions without arguments besides the token, two of them are the same request
+COALESCED_ACTIONS = ('getInfo', 'requestProfile', 'requestStock')
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter, refilled with rate tokens per second up to
+    burst tokens.
+
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._updated = monotonic()
+
+    def consume(self, now=None):
+        """Take a token. Returns 0 on success, otherwise the number of seconds
+        until the next token is available.
+
+        :rtype: float
+
+        """
+        now = monotonic() if now is None else now
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class Outgoing(object):
+    __slots__ = ('message', 'future', 'timeout', 'priority', 'key', 'attempts')
+
+    def __init__(self, message, future, timeout, priority, key, attempts=0):
+        self.message = message
+        self.future = future
+        self.timeout = timeout
+        self.priority = priority
+        self.key = key
+        self.attempts = attempts
+
+
+class OutboundQueue(object):
+    """Priority queue of messages waiting to be published. Identical
+    requests that are queued at the same time are coalesced into the first
+    one. Can be filled from any thread.
+
+    """
+
+    def __init__(self, priorities=None, max_size=10000, coalesce=COALESCED_ACTIONS):
+        """Create an empty queue.
+
+        :param dict priorities: Action to priority, any number, lower goes
+            first. Merged into DEFAULT_PRIORITIES, unknown actions get the
+            lowest priority
+        :param int max_size: Most messages kept, when full the oldest message
+            of the lowest priority is dropped, or the new one if its priority
+            is lower than that of every queued message
+        :param tuple coalesce: Actions whose identical requests are coalesced
+
+        """
+        self._priorities = dict(DEFAULT_PRIORITIES)
+        self._priorities.update(priorities or {})
+        for action, priority in self._priorities.items():
+            if isinstance(priority, bool) or not isinstance(priority, (int, float)):
+                raise ValueError(f'Priority of {action} is not a number: {priority!r}')
+        self._default_priority = max(self._priorities.values()) + 1
+        # Priority to its queue, highest priority first
+        self._queues = {priority: deque() for priority in
+                        sorted(set(self._priorities.values()) | {self._default_priority})}
+        self._queued = {}
+        self._coalesce = frozenset(coalesce)
+        self._lock = threading.Lock()
+        self.max_size = max_size
+        self._size = 0
+
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._size
+
+    def put(self, message, future=None, timeout=None, attempts=0):
+        """Queue a message and return its Outgoing entry. If an identical
+        request is already queued, that entry is returned instead and the
+        message is not queued again.
+
+        :param dict message: Message body to publish
+        :param concurrent.futures.Future future: Future of the reply, if any
+        :param float timeout: Seconds to wait for the reply
+        :param int attempts: Number of times the message was sent before
+        :rtype: Outgoing
+
+        """
+        action = message.get('action')
+        key = None
+        if action in self._coalesce:
+            key = (action, request_key(message))
+        priority = self._priorities.get(action, self._default_priority)
+        dropped = None
+        entry = Outgoing(message, future, timeout, priority, key, attempts)
+        with self._lock:
+            if key is not None:
+                queued = self._queued.get(key)
+                if queued is not None:
+                    self.coalesced += 1
+                    return queued
+            if self._size >= self.max_size:
+                dropped = self._drop(priority)
+                if dropped is None:
+                    # Everything queued goes before it
+                    dropped = entry
+                    self.dropped += 1
+            if dropped is not entry:
+                self._queues[priority].append(entry)
+                if key is not None:
+                    self._queued[key] = entry
+                self._size += 1
+        if dropped is not None:
+            logger.warning('Outbound queue is full, dropped %s', dropped.message.get('action'))
+            if dropped.future is not None:
+                dropped.future.set_exception(OverflowError('The outbound queue is full'))
+        return entry
+
+    def _drop(self, priority):
+        """Remove the oldest message of the lowest priority, unless that
+        priority is higher than priority.
+
+        """
+        for queued_priority, queue in reversed(self._queues.items()):
+            if queue:
+                if queued_priority < priority:
+                    return None
+                entry = queue.popleft()
+                if entry.key is not None:
+                    del self._queued[entry.key]
+                self._size -= 1
+                self.dropped += 1
+                return entry
+
+    def pop(self):
+        """Return the next message to publish, None if the queue is empty.
+
+        :rtype: Outgoing|None
+
+        """
+        with self._lock:
+            if not self._size:
+                return None
+            for queue in self._queues.values():
+                if queue:
+                    entry = queue.popleft()
+                    if entry.key is not None:
+                        del self._queued[entry.key]
+                    self._size -= 1
+                    return entry
+
+    def clear(self, error):
+        """Remove every queued message and fail the futures of their
+        replies with error. Returns the number removed.
+
+        """
+        with self._lock:
+            entries = [entry for queue in self._queues.values() for entry in queue]
+            for queue in self._queues.values():
+                queue.clear()
+            self._queued.clear()
+            self._size = 0
+        for entry in entries:
+            if entry.future is not None and not entry.future.done():
+                entry.future.set_exception(error)
+        return len(entries)
+
+    def stats(self):
+        return {'queued': self._size, 'coalesced': self.coalesced, 'dropped': self.dropped}
@@ -0,0 +1,300 @@
+import heapq
+
+from time import monotonic
+from metrics import Histogram
+from collections import deque, OrderedDict
+from concurrent.futures import Future, TimeoutError
+
+
+def request_key(message):
+    """Return the key a request is matched with its reply by, the token for
+    token based actions and the userId for the rest.
+
+    :param dict message: Request body
+    :rtype: str|int|None
+
+    """
+    if 'token' in message:
+        return message['token']
+    return message.get('payload', {}).get('userId')
+
+
+class TokenBindings(object):
+    """The token of each user. Replies of token based actions carry the
+    userId and not the token, so a reply can only be matched to its
+    request, or cached under the token, if the token was bound to the user.
+    Bindings are learnt from grantToken replies and bind, the least
+    recently bound are forgotten beyond max_size.
+
+    """
+
+    def __init__(self, max_size=100000):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.max_size = max_size
+        self._tokens = OrderedDict()  # userId to token
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def bind(self, token, user_id):
+        """Remember that token belongs to the user with user_id."""
+        tokens = self._tokens
+        tokens[user_id] = token
+        tokens.move_to_end(user_id)
+        if len(tokens) > self.max_size:
+            tokens.popitem(last=False)
+
+    def token_of(self, user_id):
+        return self._tokens.get(user_id)
+
+    def learn(self, update):
+        """Bind the token of a grantToken reply."""
+        payload = update.get('payload') or {}
+        if update.get('action') == 'grantToken' and 'token' in payload and 'userId' in payload:
+            self.bind(payload['token'], payload['userId'])
+
+    def get_state(self):
+        """Return the bindings as (token, userId) pairs, oldest first."""
+        return [(token, user_id) for user_id, token in list(self._tokens.items())]
+
+    def set_state(self, state):
+        for token, user_id in state:
+            self.bind(token, user_id)
+
+
+class PendingRequest(object):
+    __slots__ = ('action', 'key', 'future', 'sent', 'deadline')
+
+    def __init__(self, action, key, future, sent, deadline):
+        self.action = action
+        self.key = key
+        self.future = future
+        self.sent = sent
+        self.deadline = deadline
+
+
+class PendingRequests(object):
+    """Index of requests waiting for their reply on the inbound queue.
+
+    Requests are kept per (action, key) in order of sending, so a reply is
+    matched to the oldest request with the same action and token (or userId)
+    in constant time. Deadlines live in a heap and are only looked at by
+    expire, which fails timed out requests with timeout_error.
+
+    Replies of token based actions carry the userId and not the token,
+    they are matched through TokenBindings.
+
+    """
+
+    def __init__(self, timeout=30, max_pending=10000, future_factory=Future,
+                 timeout_error=TimeoutError, tokens=None):
+        """Create an empty index.
+
+        :param float|dict timeout: Seconds to wait for a reply, or a dict of
+            action to seconds with the default under None
+        :param int max_pending: Most requests waiting at the same time
+        :param function future_factory: Creates the future of a request
+        :param type timeout_error: Exception set on timed out futures
+        :param TokenBindings tokens: Token of each user, shared with the
+            client. A new one is made if not given
+
+        """
+        if isinstance(timeout, dict):
+            self._timeouts = dict(timeout)
+        else:
+            self._timeouts = {None: timeout}
+        self._timeouts.setdefault(None, 30)
+        self.max_pending = max_pending
+        self._future_factory = future_factory
+        self._timeout_error = timeout_error
+
+        self._requests = {}
+        self._deadlines = []
+        self.tokens = tokens if tokens is not None else TokenBindings()
+        self._sequence = 0
+        self.pending = 0
+
+        self.resolved = 0
+        self.timed_out = 0
+        self.latency = {}
+
+    def __len__(self):
+        return self.pending
+
+    def get_timeout(self, action):
+        return self._timeouts.get(action, self._timeouts[None])
+
+    def bind_token(self, token, user_id):
+        """Remember the token of a user, so that replies to requests made
+        with that token can be matched.
+
+        """
+        self.tokens.bind(token, user_id)
+
+    def add(self, message, timeout=None, future=None):
+        """Register a request that is about to be published and return the
+        future of its reply.
+
+        :param dict message: Request body
+        :param float timeout: Seconds to wait, defaults to the action timeout
+        :param future: Future to resolve, a new one is made if not given
+        :raises OverflowError: if max_pending requests are already waiting
+
+        """
+        if self.pending >= self.max_pending:
+            self.expire()
+            if self.pending >= self.max_pending:
+                raise OverflowError(f'{self.pending} requests are already waiting for a reply')
+        action = message['action']
+        if timeout is None:
+            timeout = self.get_timeout(action)
+        sent = monotonic()
+        if future is None:
+            future = self._future_factory()
+        request = PendingRequest(action, request_key(message), future, sent, sent + timeout)
+        index = (action, request.key)
+        waiting = self._requests.get(index)
+        if waiting is None:
+            waiting = self._requests[index] = deque()
+        waiting.append(request)
+        if len(self._deadlines) > 2 * self.max_pending:
+            self._compact()
+        self._sequence += 1
+        heapq.heappush(self._deadlines, (request.deadline, self._sequence, request))
+        self.pending += 1
+        return request.future
+
+    def discard(self, message, future):
+        """Forget the request of future without completing it, e.g. when
+        publishing it failed. Returns True if it was waiting.
+
+        :param dict message: Request body passed to add
+        :param future: Future returned by add
+
+        """
+        index = (message['action'], request_key(message))
+        waiting = self._requests.get(index)
+        for request in waiting or ():
+            if request.future is future:
+                waiting.remove(request)
+                if not waiting:
+                    del self._requests[index]
+                request.deadline = None  # left in the heap, skipped by expire
+                self.pending -= 1
+                return True
+        return False
+
+    def find(self, message):
+        """Return the future of the newest request identical in action and
+        token (or userId) to the message, None if there is none waiting.
+
+        :param dict message: Request body
+
+        """
+        waiting = self._requests.get((message.get('action'), request_key(message)))
+        if waiting:
+            return waiting[-1].future
+        return None
+
+    def resolve(self, update):
+        """Complete the oldest request the reply belongs to and return it,
+        None if there was none.
+
+        :param dict update: Reply off the inbound queue
+
+        """
+        action = update.get('action')
+        payload = update.get('payload') or {}
+        self.tokens.learn(update)
+
+        # Actions like getInfo have neither and are kept under None
+        request = self._pop(action, payload.get('token'))
+        if request is None and 'userId' in payload:
+            user_id = payload['userId']
+            request = self._pop(action, user_id)
+            if request is None:
+                token = self.tokens.token_of(user_id)
+                if token is not None:
+                    request = self._pop(action, token)
+        if request is None:
+            return None
+
+        elapsed = monotonic() - request.sent
+        histogram = self.latency.get(action)
+        if histogram is None:
+            histogram = self.latency[action] = Histogram()
+        histogram.observe(elapsed)
+        self.resolved += 1
+        if not request.future.done():
+            request.future.set_result(update)
+        return request
+
+    def _pop(self, action, key):
+        waiting = self._requests.get((action, key))
+        if not waiting:
+            return None
+        request = waiting.popleft()
+        if not waiting:
+            del self._requests[(action, key)]
+        request.deadline = None  # left in the heap, skipped by expire
+        self.pending -= 1
+        return request
+
+    def expire(self, now=None):
+        """Fail every request whose deadline passed. Returns their number."""
+        now = monotonic() if now is None else now
+        deadlines = self._deadlines
+        expired = 0
+        while deadlines and deadlines[0][0] <= now:
+            deadline, _, request = heapq.heappop(deadlines)
+            if request.deadline is None:
+                continue
+            waiting = self._requests[(request.action, request.key)]
+            waiting.remove(request)  # it is almost always the first one
+            if not waiting:
+                del self._requests[(request.action, request.key)]
+            self.pending -= 1
+            expired += 1
+            if not request.future.done():
+                request.future.set_exception(self._timeout_error(
+                    f'No reply to {request.action} within {deadline - request.sent:.1f}s'))
+        self.timed_out += expired
+        if not self.pending and deadlines:
+            # Everything got its reply, drop the stale heap entries at once
+            self._deadlines = []
+        return expired
+
+    def _compact(self):
+        self._deadlines = [entry for entry in self._deadlines if entry[2].deadline is not None]
+        heapq.heapify(self._deadlines)
+
+    def fail_all(self, error):
+        """Fail the futures of every waiting request with error, e.g. once
+        the client stopped. Returns their number.
+
+        """
+        failed = self.pending
+        for waiting in self._requests.values():
+            for request in waiting:
+                if not request.future.done():
+                    request.future.set_exception(error)
+        self._requests.clear()
+        self._deadlines = []
+        self.pending = 0
+        return failed
+
+    def cancel_all(self):
+        """Cancel the futures of every waiting request."""
+        for waiting in self._requests.values():
+            for request in waiting:
+                request.future.cancel()
+        self._requests.clear()
+        self._deadlines = []
+        self.pending = 0
+
+    def stats(self):
+        return {'pending': self.pending, 'resolved': self.resolved,
+                'timed_out': self.timed_out,
+                'latency': {action: histogram.snapshot()
+                            for action, histogram in self.latency.items()}}
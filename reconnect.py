@@ -0,0 +1,39 @@
+import random
+
+# Seconds, for the histogram of the time from losing the connection to
+# consuming again
+RECOVERY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Backoff(object):
+    """Exponential backoff with jitter. The n-th delay is drawn between
+    half of and the full initial * multiplier ** n, capped at maximum, so
+    clients that lost the broker at the same time do not come back in step.
+
+    """
+
+    def __init__(self, initial=1, maximum=60, multiplier=2, rand=random.random):
+        """Create a backoff at its first attempt.
+
+        :param float initial: Seconds before the first attempt
+        :param float maximum: Longest delay in seconds
+        :param float multiplier: Growth of the delay per attempt
+        :param function rand: Returns a float in [0, 1)
+
+        """
+        if initial <= 0 or maximum < initial or multiplier < 1:
+            raise ValueError('Expected 0 < initial <= maximum and multiplier >= 1')
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self._rand = rand
+        self.attempts = 0
+
+    def next(self):
+        """Return the delay of the next attempt in seconds."""
+        ceiling = min(self.initial * self.multiplier ** min(self.attempts, 64), self.maximum)
+        self.attempts += 1
+        return ceiling / 2 * (1 + self._rand())
+
+    def reset(self):
+        self.attempts = 0
@@ -0,0 +1,201 @@
+import os
+import mmap
+import time
+import struct
+import logging
+import threading
+
+from codec import get_decoder
+
+logger = logging.getLogger(__name__)
+
+QUEUES = ('inbound', 'deals', 'offers', 'sex_digest', 'au_digest', 'yellow_pages')
+
+# ChatWars method that dispatches a decoded message of each queue
+DISPATCHERS = {'inbound': 'dispatch', 'deals': 'dispatch_deal', 'offers': 'dispatch_offers',
+               'sex_digest': 'dispatch_sex', 'au_digest': 'dispatch_au',
+               'yellow_pages': 'dispatch_yellow'}
+
+MAGIC = b'CWLOG01\n'
+RECORD = struct.Struct('<dBI')  # received time, queue index, body length
+SEGMENT_NAME = 'segment-{:08d}.cwlog'
+
+
+def segment_paths(directory):
+    """Return the segment files of a log directory in the order written."""
+    names = sorted(name for name in os.listdir(directory)
+                   if name.startswith('segment-') and name.endswith('.cwlog'))
+    return [os.path.join(directory, name) for name in names]
+
+
+def read_segment(path):
+    """Yield (time, queue, body) of every record of a segment file. The file
+    is memory mapped, a record cut short by a crash ends the segment.
+
+    :param str path: Segment file
+    :rtype: generator
+
+    """
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size <= len(MAGIC):
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            if view[:len(MAGIC)] != MAGIC:
+                raise ValueError(f'Not a message log segment: {path}')
+            offset = len(MAGIC)
+            while offset + RECORD.size <= size:
+                received, queue, length = RECORD.unpack_from(view, offset)
+                offset += RECORD.size
+                if offset + length > size:
+                    logger.warning('Truncated record at %s of %s', offset, path)
+                    return
+                yield received, QUEUES[queue], view[offset:offset + length]
+                offset += length
+
+
+class MessageRecorder(object):
+    """Appends the raw bodies of consumed messages with their queue and the
+    time they were received to binary segment files in a directory. A new
+    segment is started when the current one would grow past segment_size,
+    segments of earlier runs are kept and continued after.
+
+        recorder = MessageRecorder('log')
+        cw = ChatWars(username, password, recorder=recorder)
+
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, queues=None):
+        """Create a recorder, the directory is created if needed.
+
+        :param str directory: Directory of the segment files
+        :param int segment_size: Bytes after which a new segment is started
+        :param tuple queues: Only record these queues, defaults to all
+        """
+        if segment_size <= len(MAGIC) + RECORD.size:
+            raise ValueError('segment_size is too small')
+        unknown = set(queues or ()) - set(QUEUES)
+        if unknown:
+            raise ValueError(f'Unknown queues: {", ".join(sorted(unknown))}')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self._queues = {name: index for index, name in enumerate(QUEUES)
+                        if not queues or name in queues}
+        existing = segment_paths(directory)
+        self._number = int(os.path.basename(existing[-1])[8:16]) + 1 if existing else 0
+        self._file = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self.records = 0
+        self.bytes = 0
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.directory, SEGMENT_NAME.format(self._number))
+        self._number += 1
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._size = len(MAGIC)
+        logger.info('Recording messages to %s', path)
+
+    def record(self, name, body, now=None):
+        """Append a message body.
+
+        :param str name: Queue name, one of QUEUES
+        :param bytes body: The raw message body
+        :param float now: Time received, defaults to time.time()
+
+        """
+        queue = self._queues.get(name)
+        if queue is None:
+            return
+        if isinstance(body, str):
+            body = body.encode()
+        header = RECORD.pack(time.time() if now is None else now, queue, len(body))
+        with self._lock:
+            if self._file is None or self._size + len(header) + len(body) > self.segment_size:
+                self._rotate()
+            self._file.write(header)
+            self._file.write(body)
+            self._size += len(header) + len(body)
+            self.records += 1
+            self.bytes += len(body)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class MessageReplayer(object):
+    """Plays a log written by MessageRecorder back into the dispatch methods
+    of a ChatWars instance, without a broker. Handlers and subscribers see
+    the messages as if they were consumed.
+
+        cw = ChatWars(username, password)
+        cw.subscribe('offers', book.add_offer)
+        MessageReplayer('log').replay(cw, speed=10)
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._stop = threading.Event()
+        self.replayed = 0
+        self.errors = 0
+
+    def __iter__(self):
+        """Yield (time, queue, body) of every recorded message in order."""
+        for path in segment_paths(self.directory):
+            yield from read_segment(path)
+
+    def stop(self):
+        """Make a running replay return after the current message."""
+        self._stop.set()
+
+    def replay(self, client, speed=1.0, queues=None, decoder=None):
+        """Decode the recorded messages and pass them to the dispatch methods
+        of the client. Handler errors are logged and counted like they are
+        when consuming.
+
+        :param api.ChatWars client: Instance to dispatch to
+        :param float speed: 1 keeps the recorded pace, 10 plays ten times
+            faster, None or 0 as fast as possible
+        :param tuple queues: Only replay these queues, defaults to all
+        :param str|function decoder: JSON decoder, see codec.get_decoder
+        :return: Number of messages replayed
+        :rtype: int
+
+        """
+        decode = decoder if callable(decoder) else get_decoder(decoder)
+        dispatchers = {name: getattr(client, method) for name, method in DISPATCHERS.items()}
+        self._stop.clear()
+        replayed = 0
+        first = started = None
+        for received, name, body in self:
+            if self._stop.is_set():
+                break
+            if queues and name not in queues:
+                continue
+            if speed:
+                if first is None:
+                    first, started = received, time.monotonic()
+                delay = (received - first) / speed - (time.monotonic() - started)
+                if delay > 0 and self._stop.wait(delay):
+                    break
+            try:
+                dispatchers[name](decode(body))
+            except Exception:
+                logger.exception('Failed to replay message from %s', name)
+                self.errors += 1
+            replayed += 1
+        self.replayed += replayed
+        return replayed
@@ -0,0 +1,181 @@
+import threading
+
+from bisect import insort, bisect_left
+
+
+def shop_signature(shop):
+    return (shop.get('name'), shop.get('ownerName'), shop.get('ownerCastle'),
+            tuple((offer['item'], offer['price']) for offer in shop.get('offers', ())))
+
+
+class ShopDirectory(object):
+    """Directory of the shops listed in the yellow_pages stream.
+
+    A yellow_pages message lists every open shop. It is applied as a diff
+    against the previous one: unchanged shops are skipped, changed shops
+    are re-indexed and shops that are no longer listed are marked closed.
+    Besides the shops by link it keeps inverted indexes of the offers by
+    item, sorted by price, and of the shops by owner, castle and open state,
+    so queries do not scan the directory.
+
+        directory = ShopDirectory()
+        cw.subscribe('yellow_pages', directory.apply)
+        directory.cheapest('Thread', 3)
+
+    """
+
+    def __init__(self):
+        self._shops = {}  # link to shop
+        self._signatures = {}  # link to shop_signature of the indexed shop
+        self._items = {}  # lowercased item to sorted [(price, link)]
+        self._owners = {}  # ownerName to set of links
+        self._castles = {}  # ownerCastle to set of links
+        self._open = set()
+        self._lock = threading.RLock()
+        self.updates = 0
+        self.changed = 0
+
+    def __len__(self):
+        return len(self._shops)
+
+    def apply(self, update):
+        """Apply a yellow_pages message. Returns the links of the shops that
+        opened, changed and closed.
+
+        :param list update: Message body, the list of open shops
+        :rtype: tuple
+
+        """
+        opened, changed = [], []
+        with self._lock:
+            listed = set()
+            for shop in update:
+                link = shop['link']
+                listed.add(link)
+                signature = shop_signature(shop)
+                if link not in self._open:
+                    opened.append(link)
+                    self._open.add(link)
+                elif self._signatures.get(link) == signature:
+                    self._shops[link] = shop
+                    continue
+                else:
+                    changed.append(link)
+                self._unindex(link)
+                self._index(link, shop, signature)
+            closed = list(self._open - listed)
+            for link in closed:
+                # Closed shops stay in the directory without their offers
+                self._open.discard(link)
+                self._unindex_offers(link)
+                self._signatures[link] = None
+            self.updates += 1
+            self.changed += len(opened) + len(changed) + len(closed)
+        return opened, changed, closed
+
+    def _index(self, link, shop, signature):
+        self._shops[link] = shop
+        self._signatures[link] = signature
+        self._owners.setdefault(shop.get('ownerName'), set()).add(link)
+        self._castles.setdefault(shop.get('ownerCastle'), set()).add(link)
+        for item, price in signature[3]:
+            insort(self._items.setdefault(item.lower(), []), (price, link))
+
+    def _unindex(self, link):
+        shop = self._shops.get(link)
+        if shop is None:
+            return
+        self._unindex_offers(link)
+        self._discard(self._owners, shop.get('ownerName'), link)
+        self._discard(self._castles, shop.get('ownerCastle'), link)
+        del self._signatures[link]
+
+    def _unindex_offers(self, link):
+        signature = self._signatures.get(link)
+        if signature is None:
+            return
+        for item, price in signature[3]:
+            offers = self._items.get(item.lower())
+            if offers is None:
+                continue
+            index = bisect_left(offers, (price, link))
+            if index < len(offers) and offers[index] == (price, link):
+                del offers[index]
+            if not offers:
+                del self._items[item.lower()]
+
+    @staticmethod
+    def _discard(index, key, link):
+        links = index.get(key)
+        if links is not None:
+            links.discard(link)
+            if not links:
+                del index[key]
+
+    def get_state(self):
+        """Return the shops and which of them are open as plain data."""
+        with self._lock:
+            return dict(self._shops), list(self._open), self.updates, self.changed
+
+    def set_state(self, state):
+        """Replace the directory with one returned by get_state and rebuild
+        the indexes.
+
+        """
+        shops, opened, updates, changed = state
+        opened = set(opened)
+        with self._lock:
+            self._shops, self._signatures, self._items = {}, {}, {}
+            self._owners, self._castles, self._open = {}, {}, opened
+            for link, shop in shops.items():
+                self._index(link, shop, shop_signature(shop))
+                if link not in opened:
+                    self._unindex_offers(link)
+                    self._signatures[link] = None
+            self.updates = updates
+            self.changed = changed
+
+    def shop(self, link):
+        return self._shops.get(link)
+
+    def is_open(self, link):
+        return link in self._open
+
+    def cheapest(self, item, limit=5):
+        """Return up to limit (price, shop) pairs of open shops selling an
+        item, cheapest first.
+
+        :param str item: Item name, case insensitive
+        :param int limit: Most pairs returned
+        :rtype: list
+
+        """
+        with self._lock:
+            offers = self._items.get(item.lower(), ())
+            return [(price, self._shops[link]) for price, link in offers[:limit]]
+
+    def shops_of_owner(self, owner, open_only=False):
+        with self._lock:
+            links = self._owners.get(owner, ())
+            return [self._shops[link] for link in links
+                    if not open_only or link in self._open]
+
+    def shops_of_castle(self, castle, open_only=True):
+        with self._lock:
+            links = self._castles.get(castle, ())
+            return [self._shops[link] for link in links
+                    if not open_only or link in self._open]
+
+    def open_shops(self):
+        with self._lock:
+            return [self._shops[link] for link in self._open]
+
+    def items(self):
+        with self._lock:
+            return list(self._items)
+
+    def stats(self):
+        with self._lock:
+            return {'shops': len(self._shops), 'open': len(self._open),
+                    'items': len(self._items), 'updates': self.updates,
+                    'changed': self.changed}
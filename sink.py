@@ -0,0 +1,288 @@
+import time
+import logging
+import sqlite3
+import threading
+
+from digests import AuctionDiffer, ExchangeSnapshot
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Table to its columns after time, as (column, field of the update)
+TABLES = {
+    'deals': (('seller_id', 'sellerId'), ('seller_name', 'sellerName'),
+              ('seller_castle', 'sellerCastle'), ('buyer_id', 'buyerId'),
+              ('buyer_name', 'buyerName'), ('buyer_castle', 'buyerCastle'),
+              ('item', 'item'), ('qty', 'qty'), ('price', 'price')),
+    'offers': (('seller_id', 'sellerId'), ('seller_name', 'sellerName'),
+               ('seller_castle', 'sellerCastle'), ('item', 'item'), ('qty', 'qty'),
+               ('price', 'price')),
+    # change is new, changed or closed
+    'lots': (('change', None), ('lot_id', 'lotId'), ('item_name', 'itemName'),
+             ('seller_name', 'sellerName'), ('seller_castle', 'sellerCastle'),
+             ('quality', 'quality'), ('status', 'status'), ('price', 'price'),
+             ('buyer_name', 'buyerName'), ('buyer_castle', 'buyerCastle'), ('end_at', 'endAt')),
+    'prices': (('item', None), ('previous', None), ('price', None)),
+}
+
+
+def row_of(table, now, update):
+    if table == 'lots':
+        change, update = update
+        return (now, change) + tuple(update.get(field) for _, field in TABLES['lots'][1:])
+    if table == 'prices':
+        return (now,) + tuple(update)
+    return (now,) + tuple(update.get(field) for _, field in TABLES[table])
+
+
+class SQLiteSink(object):
+    """Persists deals, offers and digest changes to a SQLite database.
+
+    The subscribers only append the updates to a buffer, a writer thread
+    inserts them with executemany in one transaction per batch. A batch is
+    written once batch_size rows are waiting or the oldest has waited
+    max_delay seconds. The database is in WAL mode, so it can be read while
+    the writer inserts.
+
+    When the writer falls behind and max_pending rows are waiting, adding
+    more blocks for up to timeout seconds. Called from the IOLoop, that
+    stops the acks too, and the broker stops delivering once the prefetch
+    windows are full, so the consumers slow down to what the disk takes.
+    Rows that still do not fit are dropped and counted. Updates that cannot
+    be turned into a row are counted as failed.
+
+        sink = SQLiteSink('market.db')
+        sink.attach(cw)
+        cw.run()
+        sink.close()
+
+    """
+
+    def __init__(self, path, batch_size=5000, max_delay=1.0, max_pending=100000,
+                 block=True, timeout=1.0, synchronous='NORMAL'):
+        """Create the tables if needed and start the writer thread.
+
+        :param str path: Database file
+        :param int batch_size: Rows written per transaction at most
+        :param float max_delay: Seconds a row may wait for its batch to fill
+        :param int max_pending: Rows waiting to be written before adding
+            more blocks or drops
+        :param bool block: Wait for the writer when the buffer is full,
+            False drops right away
+        :param float timeout: Seconds to wait for the writer, None waits as
+            long as it takes. Keep it well below the heartbeat interval when
+            adding from the IOLoop, see attach
+        :param str synchronous: SQLite synchronous pragma, NORMAL is safe
+            against corruption in WAL mode but may lose the last
+            transactions on power loss
+
+        """
+        if batch_size < 1 or max_pending < batch_size:
+            raise ValueError('Expected 1 <= batch_size <= max_pending')
+        self.path = path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.block = block
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self._pending = []  # (table, time, update)
+        self._oldest = None
+        self._flush_target = 0
+        self._closing = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._progress = threading.Condition(self._lock)
+        self.queued = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.batches = 0
+        self.write_latency = Histogram()
+
+        self._connect().close()  # Fail here on a bad path
+        self._thread = threading.Thread(target=self._run, name='sqlite-sink', daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(f'PRAGMA synchronous={self.synchronous}')
+        for table, columns in TABLES.items():
+            db.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                       f'(time REAL, {", ".join(column for column, _ in columns)})')
+        return db
+
+    def __len__(self):
+        return len(self._pending)
+
+    def attach(self, cw, streams=('deals', 'offers', 'au_digest', 'sex_digest')):
+        """Subscribe the sink to streams of a ChatWars instance. au_digest
+        and sex_digest are diffed first, only their changes are stored.
+
+        The subscribers run on the IOLoop, while one waits for a full buffer
+        pika 0.13 sends no heartbeats, so a timeout close to the heartbeat
+        interval gets the connection closed by the broker.
+
+        :return: The AuctionDiffer and ExchangeSnapshot created, if any
+        :rtype: dict
+
+        """
+        created = {}
+        for stream in streams:
+            if stream == 'deals':
+                cw.subscribe(stream, self.on_deal)
+            elif stream == 'offers':
+                cw.subscribe(stream, self.on_offer)
+            elif stream == 'au_digest':
+                created[stream] = AuctionDiffer()
+                created[stream].add_handler(self.on_auction)
+                cw.subscribe(stream, created[stream].apply)
+            elif stream == 'sex_digest':
+                created[stream] = ExchangeSnapshot()
+                created[stream].add_handler(self.on_exchange)
+                cw.subscribe(stream, created[stream].apply)
+            else:
+                raise ValueError(f'Cannot store stream {stream}')
+        return created
+
+    def on_deal(self, update):
+        return self.put('deals', (update,))
+
+    def on_offer(self, update):
+        return self.put('offers', (update,))
+
+    def on_auction(self, diff):
+        """Handler of an AuctionDiffer, stores every lot of the diff."""
+        changes = [('new', lot) for lot in diff.new]
+        changes.extend(('changed', current) for _, current in diff.changed)
+        changes.extend(('closed', lot) for lot in diff.closed)
+        return self.put('lots', changes)
+
+    def on_exchange(self, changes):
+        """Handler of an ExchangeSnapshot, stores the price moves."""
+        return self.put('prices', changes)
+
+    def put(self, table, updates, now=None):
+        """Queue updates for a table. Blocks while the buffer is full.
+
+        :param str table: One of TABLES
+        :param list updates: Message bodies, (change, lot) pairs for lots
+            and (item, previous, price) for prices
+        :param float now: Time of the updates, defaults to time.time()
+        :return: False if the updates were dropped
+        :rtype: bool
+
+        """
+        if table not in TABLES:
+            raise ValueError(f'Unknown table: {table}')
+        now = time.time() if now is None else now
+        with self._lock:
+            if self._closing:
+                raise ValueError('The sink is closed')
+            if len(self._pending) >= self.max_pending:
+                self.blocked += 1
+                if not self.block or not self._progress.wait_for(
+                        lambda: len(self._pending) < self.max_pending or self._closing,
+                        self.timeout):
+                    self.dropped += len(updates)
+                    logger.warning('SQLite sink is %i rows behind, dropped %i',
+                                   len(self._pending), len(updates))
+                    return False
+                if self._closing:
+                    raise ValueError('The sink is closed')
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.extend((table, now, update) for update in updates)
+            self.queued += len(updates)
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.notify()
+        return True
+
+    def flush(self, timeout=None):
+        """Write everything queued so far and wait for it. Returns False if
+        that took longer than timeout seconds.
+
+        """
+        with self._lock:
+            target = self.queued
+            self._flush_target = max(self._flush_target, target)
+            self._wakeup.notify()
+            return self._progress.wait_for(
+                lambda: self.written + self.failed >= target or not self._thread.is_alive(), timeout)
+
+    def close(self, timeout=None):
+        """Write what is left, stop the writer and close the database."""
+        with self._lock:
+            self._closing = True
+            self._wakeup.notify()
+            self._progress.notify_all()
+        self._thread.join(timeout)
+
+    def _next_batch(self):
+        with self._lock:
+            while True:
+                waiting = len(self._pending)
+                if waiting:
+                    delay = self.max_delay - (time.monotonic() - self._oldest)
+                    if (waiting >= self.batch_size or delay <= 0 or self._closing or
+                            self.written + self.failed < self._flush_target):
+                        break
+                elif self._closing:
+                    return None
+                else:
+                    delay = None
+                self._wakeup.wait(delay)
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            self._oldest = time.monotonic() if self._pending else None
+            self._progress.notify_all()
+            return batch
+
+    def _run(self):
+        db = self._connect()
+        inserts = {table: f'INSERT INTO {table} VALUES ({", ".join("?" * (len(columns) + 1))})'
+                   for table, columns in TABLES.items()}
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                started = time.perf_counter()
+                rows = {}
+                bad = 0
+                for table, now, update in batch:
+                    try:
+                        rows.setdefault(table, []).append(row_of(table, now, update))
+                    except Exception:
+                        logger.exception('Cannot store %r in %s', update, table)
+                        bad += 1
+                try:
+                    db.execute('BEGIN')
+                    for table, values in rows.items():
+                        db.executemany(inserts[table], values)
+                    db.execute('COMMIT')
+                    written, failed = len(batch) - bad, bad
+                except Exception:
+                    logger.exception('Failed to write %i rows', len(batch) - bad)
+                    if db.in_transaction:
+                        db.execute('ROLLBACK')
+                    written, failed = 0, len(batch)
+                self.write_latency.observe(time.perf_counter() - started)
+                with self._lock:
+                    self.written += written
+                    self.failed += failed
+                    self.batches += 1
+                    self._progress.notify_all()
+        finally:
+            db.close()
+            with self._lock:
+                self._progress.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending), 'queued': self.queued,
+                    'written': self.written, 'failed': self.failed, 'dropped': self.dropped,
+                    'blocked': self.blocked, 'batches': self.batches,
+                    'write_latency': self.write_latency.snapshot()}
@@ -0,0 +1,99 @@
+import logging
+import threading
+
+from functools import partial
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class OrderedDispatcher(object):
+    """Runs handlers on a concurrent.futures executor while keeping the
+    order of updates that share a key. Updates with different keys run in
+    parallel, updates with the same key run one after another in the order
+    they were submitted.
+
+    Works with both ThreadPoolExecutor and ProcessPoolExecutor, in the
+    latter case the handlers and updates have to be picklable, so handlers
+    must be module level functions.
+
+    """
+
+    def __init__(self, executor, max_in_flight=None):
+        """Create a dispatcher on top of an executor.
+
+        :param concurrent.futures.Executor executor: Runs the handlers
+        :param int max_in_flight: Handlers queued or running that one
+            consumer is expected to have at most. Not enforced here, ChatWars
+            uses it as the default prefetch count of each consumer
+
+        """
+        self._executor = executor
+        self.max_in_flight = max_in_flight or getattr(executor, '_max_workers', 1) * 4
+        self._lock = threading.Lock()
+        self._queues = {}
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def executor(self):
+        return self._executor
+
+    def submit(self, key, handler, update, callback):
+        """Schedule handler(update). callback(success) is invoked from the
+        executor's thread once the handler finished.
+
+        :param key: Hashable key, updates with the same key keep their order
+        :param function handler: A function that takes 1 positional argument
+        :param dict update: Message body as dict
+        :param function callback: A function that takes a bool
+
+        """
+        with self._lock:
+            self.in_flight += 1
+            waiting = self._queues.get(key)
+            if waiting is not None:
+                waiting.append((handler, update, callback))
+                return
+            self._queues[key] = deque()
+        self._start(key, handler, update, callback)
+
+    def _start(self, key, handler, update, callback):
+        try:
+            future = self._executor.submit(handler, update)
+        except Exception:
+            logger.exception('Failed to submit handler for %r', key)
+            self._finish(key, callback, False)
+        else:
+            future.add_done_callback(partial(self._on_done, key, callback))
+
+    def _on_done(self, key, callback, future):
+        if future.cancelled():
+            success = False
+        else:
+            error = future.exception()
+            success = error is None
+            if error is not None:
+                logger.error('Handler for %r failed', key, exc_info=error)
+        self._finish(key, callback, success)
+
+    def _finish(self, key, callback, success):
+        try:
+            callback(success)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                if success:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                waiting = self._queues[key]
+                following = waiting.popleft() if waiting else None
+                if following is None:
+                    del self._queues[key]
+            if following is not None:
+                self._start(key, *following)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)